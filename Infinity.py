@@ -2,7 +2,10 @@ import logging
 import json
 import os
 import asyncio
-from typing import Dict, Optional, Any, List
+import signal
+import time
+from functools import partial
+from typing import Dict, Optional, Any, List, Tuple
 
 # Telegram Imports
 from telegram import (
@@ -12,74 +15,96 @@ from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
     ApplicationBuilder,
     CallbackQueryHandler,
+    ApplicationHandlerStop,
 )
 from telegram.constants import ChatAction, ParseMode, ChatType
 from telegram.error import TelegramError, BadRequest
 
 from google import genai
-from data_management import load_data, save_data
+from data_management import load_data, save_data, serialize_json
+from message_index import MessageIndex
+from log_pipeline import setup_logging, start_update_context, bind_log_context, SAMPLED
+from formatting import escape_markdown_v2, format_user_reply, format_topic_copy
+from search_index import matches_all, tokenize
+import lifecycle
+import quotas
+from scheduler import FairScheduler
+from tenants import (
+    Tenant, current_tenant, set_current_tenant, tenant_scope, load_tenants,
+    SharedHTTPXRequest, DEFAULT_TENANT_NAME, TELEGRAM_CONNECTION_POOL_SIZE,
+)
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATA_FILE_PATH = "user_topic_map.json"
 CONVERSATION_HISTORY_FILE_PATH = "conversation_history.json"
 
 # --- Configuration ---
+# Settings of the default bot; more bots can be added in tenants.json
 BOT_TOKEN = "Please Fill it with your bot token"
 SUPPORT_GROUP_ID = -1234567890
 GEMINI_API_KEY = "Please Fill it with your Gemini API key"
 YOUR_NAME = "Please Fill it with your Name"
 
 AI_MODEL_NAME = "gemini-2.0-flash-thinking-exp-01-21"
+# Telegram shows a chat action for about 5 seconds, so it is resent while the AI reply is pending
+TYPING_REFRESH_SECONDS = 4
+TYPING_MAX_SECONDS = 120
 
 # Base prompt for the AI
 # Please change it to your own base prompt
-GEMINI_BASE_PROMPT = f"Act as {YOUR_NAME} and Chat with the User Through the Chat History(If Have) in a Short Sentance:"
-_user_topic_map = {"support_group_id": SUPPORT_GROUP_ID, "user_mappings": {}}
-_user_conversation_history = {}
+GEMINI_BASE_PROMPT_TEMPLATE = "Act as {name} and Chat with the User Through the Chat History(If Have) in a Short Sentance:"
+GEMINI_BASE_PROMPT = GEMINI_BASE_PROMPT_TEMPLATE.format(name=YOUR_NAME)
+# Shared by all bots so AI replies are scheduled fairly across the whole process
+_ai_scheduler: Optional[FairScheduler] = None
+_genai_clients: Dict[str, Any] = {}
 
 logger.info(f"Gemini API key provided: {'Yes' if GEMINI_API_KEY else 'No'}")
 
 def load_data() -> None:
-    global _user_topic_map
+    tenant = current_tenant()
+    data_file_path = tenant.data_file_path
+    support_group_id = tenant.support_group_id
+    empty_map = {"support_group_id": support_group_id, "user_mappings": {}, "username_tags": {}}
     try:
-        if os.path.exists(DATA_FILE_PATH):
-            with open(DATA_FILE_PATH, "r", encoding="utf-8") as f:
+        if os.path.exists(data_file_path):
+            with open(data_file_path, "r", encoding="utf-8") as f:
                 data = json.load(f)
                 if isinstance(data, dict) and "user_mappings" in data and isinstance(data["user_mappings"], dict):
-                    _user_topic_map = data
-                    if _user_topic_map.get("support_group_id") != SUPPORT_GROUP_ID:
+                    tenant.user_topic_map = data
+                    if data.get("support_group_id") != support_group_id:
                         logger.warning(
-                            f"Support group ID in {DATA_FILE_PATH} ({_user_topic_map.get('support_group_id')}) "
-                            f"differs from config ({SUPPORT_GROUP_ID}). Using config value."
+                            f"Support group ID in {data_file_path} ({data.get('support_group_id')}) "
+                            f"differs from config ({support_group_id}). Using config value."
                         )
-                        _user_topic_map["support_group_id"] = SUPPORT_GROUP_ID
+                        data["support_group_id"] = support_group_id
                     needs_save = False
-                    for user_id, user_data in _user_topic_map["user_mappings"].items():
+                    for user_id, user_data in data["user_mappings"].items():
                         if "ai_mode_enabled" not in user_data:
                             logger.info(f"Adding missing 'ai_mode_enabled' (defaulting to True) for user {user_id}")
                             user_data["ai_mode_enabled"] = True
                             needs_save = True
-                    logger.info(f"Successfully loaded data from {DATA_FILE_PATH}")
+                    logger.info(f"Successfully loaded data from {data_file_path}")
                     if needs_save:
                         save_data()
                 else:
-                    logger.warning(f"Invalid format in {DATA_FILE_PATH}. Starting with empty map.")
-                    _user_topic_map = {"support_group_id": SUPPORT_GROUP_ID, "user_mappings": {}}
+                    logger.warning(f"Invalid format in {data_file_path}. Starting with empty map.")
+                    tenant.user_topic_map = empty_map
         else:
-            logger.info(f"{DATA_FILE_PATH} not found. Starting with empty map.")
-            _user_topic_map = {"support_group_id": SUPPORT_GROUP_ID, "user_mappings": {}}
+            logger.info(f"{data_file_path} not found. Starting with empty map.")
+            tenant.user_topic_map = empty_map
     except json.JSONDecodeError:
-        logger.exception(f"Error decoding JSON from {DATA_FILE_PATH}. Starting with empty map.")
-        _user_topic_map = {"support_group_id": SUPPORT_GROUP_ID, "user_mappings": {}}
+        logger.exception(f"Error decoding JSON from {data_file_path}. Starting with empty map.")
+        tenant.user_topic_map = empty_map
     except Exception:
-        logger.exception(f"Failed to load data from {DATA_FILE_PATH}. Starting with empty map.")
-        _user_topic_map = {"support_group_id": SUPPORT_GROUP_ID, "user_mappings": {}}
+        logger.exception(f"Failed to load data from {data_file_path}. Starting with empty map.")
+        tenant.user_topic_map = empty_map
 
     def initialize_conversation_history():
         load_conversation_history()
@@ -88,69 +113,55 @@ def load_data() -> None:
 
 
 def save_data() -> None:
-    global _user_topic_map
-    try:
-        parent_dir = os.path.dirname(DATA_FILE_PATH)
-        if parent_dir:
-            os.makedirs(parent_dir, exist_ok=True)
-        temp_file_path = DATA_FILE_PATH + ".tmp"
-        with open(temp_file_path, "w", encoding="utf-8") as f:
-            json.dump(_user_topic_map, f, ensure_ascii=False, indent=4)
-        os.replace(temp_file_path, DATA_FILE_PATH)
-    except IOError:
-        logger.exception(f"Error: Could not write data to {DATA_FILE_PATH}")
-    except Exception:
-        logger.exception(f"An unexpected error occurred while saving data to {DATA_FILE_PATH}")
+    """Mark the user map as changed; it is written at the next checkpoint"""
+    tenant = current_tenant()
+    lifecycle.mark_dirty(tenant.state_key("user_topic_map"))
+
+def snapshot_data() -> Tuple[str, bytes]:
+    """Serialize the user map for writing to disk"""
+    tenant = current_tenant()
+    return tenant.data_file_path, serialize_json(tenant.user_topic_map)
 
 def load_conversation_history() -> None:
     """Load conversation history from JSON file"""
-    global _user_conversation_history
+    tenant = current_tenant()
+    history_file_path = tenant.conversation_history_file_path
     try:
-        if os.path.exists(CONVERSATION_HISTORY_FILE_PATH):
-            with open(CONVERSATION_HISTORY_FILE_PATH, "r", encoding="utf-8") as f:
+        if os.path.exists(history_file_path):
+            with open(history_file_path, "r", encoding="utf-8") as f:
                 data = json.load(f)
                 if isinstance(data, dict):
-                    _user_conversation_history = data
-                    logger.info(f"Successfully loaded conversation history from {CONVERSATION_HISTORY_FILE_PATH}")
+                    tenant.conversation_history = data
+                    logger.info(f"Successfully loaded conversation history from {history_file_path}")
                 else:
-                    logger.warning(f"Invalid format in {CONVERSATION_HISTORY_FILE_PATH}. Starting with empty history.")
-                    _user_conversation_history = {}
+                    logger.warning(f"Invalid format in {history_file_path}. Starting with empty history.")
+                    tenant.conversation_history = {}
         else:
-            logger.info(f"{CONVERSATION_HISTORY_FILE_PATH} not found. Starting with empty history.")
-            _user_conversation_history = {}
+            logger.info(f"{history_file_path} not found. Starting with empty history.")
+            tenant.conversation_history = {}
     except json.JSONDecodeError:
-        logger.exception(f"Error decoding JSON from {CONVERSATION_HISTORY_FILE_PATH}. Starting with empty history.")
-        _user_conversation_history = {}
+        logger.exception(f"Error decoding JSON from {history_file_path}. Starting with empty history.")
+        tenant.conversation_history = {}
     except Exception:
-        logger.exception(f"Failed to load conversation history from {CONVERSATION_HISTORY_FILE_PATH}. Starting with empty history.")
-        _user_conversation_history = {}
+        logger.exception(f"Failed to load conversation history from {history_file_path}. Starting with empty history.")
+        tenant.conversation_history = {}
+    tenant.search_index.rebuild(tenant.conversation_history)
 
-def save_conversation_history() -> None:
-    """Save conversation history to JSON file"""
-    global _user_conversation_history
-    try:
-        parent_dir = os.path.dirname(CONVERSATION_HISTORY_FILE_PATH)
-        if parent_dir:
-            os.makedirs(parent_dir, exist_ok=True)
-        temp_file_path = CONVERSATION_HISTORY_FILE_PATH + ".tmp"
-        with open(temp_file_path, "w", encoding="utf-8") as f:
-            json.dump(_user_conversation_history, f, ensure_ascii=False, indent=4)
-        os.replace(temp_file_path, CONVERSATION_HISTORY_FILE_PATH)
-        logger.info(f"Successfully saved conversation history to {CONVERSATION_HISTORY_FILE_PATH}")
-    except IOError:
-        logger.exception(f"Error: Could not write conversation history to {CONVERSATION_HISTORY_FILE_PATH}")
-    except Exception:
-        logger.exception(f"An unexpected error occurred while saving conversation history to {CONVERSATION_HISTORY_FILE_PATH}")
+def snapshot_conversation_history() -> Tuple[str, bytes]:
+    """Serialize the conversation history for writing to disk"""
+    tenant = current_tenant()
+    # Compact, since this is serialized on the event loop at every checkpoint
+    return tenant.conversation_history_file_path, serialize_json(tenant.conversation_history, indent=None)
 
 def get_user_data(user_id: int) -> Optional[Dict[str, Any]]:
-    return _user_topic_map["user_mappings"].get(str(user_id))
+    return current_tenant().user_topic_map["user_mappings"].get(str(user_id))
 
 def get_user_topic_id(user_id: int) -> Optional[int]:
     user_data = get_user_data(user_id)
     return user_data.get("topic_id") if user_data else None
 
 def get_user_id_from_topic(topic_id: int) -> Optional[int]:
-    for user_id_str, data in _user_topic_map["user_mappings"].items():
+    for user_id_str, data in current_tenant().user_topic_map["user_mappings"].items():
         if data.get("topic_id") == topic_id:
             try:
                 return int(user_id_str)
@@ -171,21 +182,27 @@ def create_topic_title(user: User) -> str:
 
 def get_conversation_history(user_id: int, max_messages: int = 10) -> List[Dict[str, str]]:
     """Get the conversation history for a user, limited to the last N messages"""
-    if str(user_id) not in _user_conversation_history:
-        _user_conversation_history[str(user_id)] = []
-    return _user_conversation_history[str(user_id)][-max_messages:]
+    conversation_history = current_tenant().conversation_history
+    if str(user_id) not in conversation_history:
+        conversation_history[str(user_id)] = []
+    return conversation_history[str(user_id)][-max_messages:]
 
 def add_to_conversation_history(user_id: int, role: str, message: str) -> None:
-    """Add a message to the user's conversation history and save to file"""
-    if str(user_id) not in _user_conversation_history:
-        _user_conversation_history[str(user_id)] = []
+    """Add a message to the user's conversation history; it is saved at the next checkpoint"""
+    tenant = current_tenant()
+    conversation_history = tenant.conversation_history
+    if str(user_id) not in conversation_history:
+        conversation_history[str(user_id)] = []
     
-    if len(_user_conversation_history[str(user_id)]) >= 20:
-        _user_conversation_history[str(user_id)].pop(0)
+    if len(conversation_history[str(user_id)]) >= 20:
+        evicted = conversation_history[str(user_id)].pop(0)
+        tenant.search_index.remove(user_id, evicted.get("message", ""))
     
-    _user_conversation_history[str(user_id)].append({"role": role, "message": message})
+    now = int(time.time())
+    conversation_history[str(user_id)].append({"role": role, "message": message, "time": now})
+    tenant.search_index.add(user_id, message, now)
     
-    save_conversation_history()
+    lifecycle.mark_dirty(tenant.state_key("conversation_history"))
 
 def is_ai_mode_enabled(user_id: int) -> bool:
     user_data = get_user_data(user_id)
@@ -193,9 +210,10 @@ def is_ai_mode_enabled(user_id: int) -> bool:
 
 def set_ai_mode(user_id: int, enabled: bool) -> bool:
     user_id_str = str(user_id)
-    if user_id_str in _user_topic_map["user_mappings"]:
-        if _user_topic_map["user_mappings"][user_id_str].get("ai_mode_enabled") != enabled:
-            _user_topic_map["user_mappings"][user_id_str]["ai_mode_enabled"] = enabled
+    user_mappings = current_tenant().user_topic_map["user_mappings"]
+    if user_id_str in user_mappings:
+        if user_mappings[user_id_str].get("ai_mode_enabled") != enabled:
+            user_mappings[user_id_str]["ai_mode_enabled"] = enabled
             save_data()
             logger.info(f"AIMode for user {user_id} set to {enabled}")
             return True
@@ -213,45 +231,41 @@ def get_aimode_toggle_keyboard(user_id: int, current_state: bool) -> InlineKeybo
     keyboard = [[InlineKeyboardButton(button_text, callback_data=callback_data)]]
     return InlineKeyboardMarkup(keyboard)
 
-def escape_markdown_v2(text: str) -> str:
-    """Escape MarkdownV2 reserved characters: _ * [ ] ( ) ~ ` > # + - = | { } . !"""
-    escape_chars = r"_*[]()~`>#+-=|{}.!"
-    for char in escape_chars:
-        text = text.replace(char, f"\\{char}")
-    return text
+async def send_chunks(bot, chat_id: int, chunks: List[str], reply_markup=None, **kwargs) -> List[Message]:
+    """Send message chunks in order, attaching reply_markup to the last one"""
+    sent = []
+    for index, chunk in enumerate(chunks):
+        markup = reply_markup if index == len(chunks) - 1 else None
+        sent.append(await bot.send_message(chat_id=chat_id, text=chunk, reply_markup=markup, **kwargs))
+    return sent
 
 def format_conversation_history(history: list) -> str:
     """Format conversation history for Gemini context"""
+    your_name = current_tenant().your_name
     formatted = "Previous conversation:\n"
     for entry in history:
-        role_name = "User" if entry["role"] == "user" else YOUR_NAME
+        role_name = "User" if entry["role"] == "user" else your_name
         formatted += f"{role_name}: {entry['message']}\n"
     return formatted
 
-async def generate_ai_reply(user_message_text: str, user_id: int) -> Optional[str]:
-    """Generate an AI reply using Gemini with conversation context"""
-    if not GEMINI_API_KEY:
-        logger.warning(f"Skipping AI reply for user {user_id}: Gemini API key not configured.")
-        return None
-
-    if not is_ai_mode_enabled(user_id):
-        logger.info(f"Skipping AI reply for user {user_id}: AIMode is disabled.")
-        return None
+def get_user_context(user_id: int) -> Tuple[List[str], str]:
+    """Return the user's tags and the user-info block of the AI prompt.
 
-    if not user_message_text:
-        logger.info(f"Skipping AI reply for user {user_id}: No text content in message.")
-        return None
+    Both are cached per user until the user's stored profile changes or this
+    tenant's tags are saved.
+    """
+    from tag_commands import get_tags_by_user_id, tags_generation
+    tenant = current_tenant()
+    generation = tags_generation(tenant.data_file_path)
+    cached = tenant.user_contexts.get(user_id)
+    if cached and cached[0] == generation:
+        return cached[1], cached[2]
 
-    logger.info(f"Attempting to generate AI reply for user {user_id} using {AI_MODEL_NAME}")
-    
-    history = get_conversation_history(user_id)
-    
-    add_to_conversation_history(user_id, "user", user_message_text)
-    
-    from tag_commands import get_tags_by_user_id
     user_data = get_user_data(user_id)
-    user_tags = get_tags_by_user_id(user_id)
-    
+    user_tags = get_tags_by_user_id(user_id, tenant.data_file_path, tenant.user_topic_map)
+    if tags_generation(tenant.data_file_path) != generation:
+        # Tags stored by username were moved onto the user
+        save_data()
     user_info = ""
     if user_data:
         username = user_data.get("username", "")
@@ -266,34 +280,97 @@ async def generate_ai_reply(user_message_text: str, user_id: int) -> Optional[st
         
         if user_tags:
             user_info += f"\nTags: {', '.join(user_tags)}"
-    
-    # Create prompt with context
+
+    tenant.user_contexts[user_id] = (tags_generation(tenant.data_file_path), user_tags, user_info)
+    return user_tags, user_info
+
+def build_ai_prompt(user_message_text: str, user_id: int, history: List[Dict[str, str]]) -> str:
+    """Assemble the Gemini prompt from the base prompt, user info, history and the new message"""
+    _, user_info = get_user_context(user_id)
     context = format_conversation_history(history) if history else ""
-    full_prompt = f"{GEMINI_BASE_PROMPT}\n\n{user_info}\n\n{context}\n\nCurrent message: \"{user_message_text}\""
+    full_prompt = f"{current_tenant().base_prompt}\n\n{user_info}\n\n{context}\n\nCurrent message: \"{user_message_text}\""
+    return full_prompt
+
+def get_genai_client(api_key: str) -> Any:
+    """Return the Gemini client for an API key, creating it on first use"""
+    client = _genai_clients.get(api_key)
+    if client is None:
+        client = _genai_clients[api_key] = genai.Client(api_key=api_key)
+    return client
+
+async def generate_ai_reply(user_message_text: str, user_id: int, history: List[Dict[str, str]]) -> Optional[str]:
+    """Generate an AI reply using Gemini with conversation context.
+
+    ``history`` is the conversation as it was before the message arrived; the
+    message itself is already in the stored history.
+    """
+    tenant = current_tenant()
+    if not tenant.gemini_api_key:
+        logger.warning("Skipping AI reply for user %s: Gemini API key not configured.", user_id)
+        return None
+
+    if not is_ai_mode_enabled(user_id):
+        logger.info("Skipping AI reply for user %s: AIMode is disabled.", user_id, extra=SAMPLED)
+        return None
+
+    if not user_message_text:
+        logger.info("Skipping AI reply for user %s: No text content in message.", user_id, extra=SAMPLED)
+        return None
+
+    logger.info("Attempting to generate AI reply for user %s using %s", user_id, AI_MODEL_NAME, extra=SAMPLED)
+
+    full_prompt = build_ai_prompt(user_message_text, user_id, history)
 
     try:
         loop = asyncio.get_running_loop()
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        client = get_genai_client(tenant.gemini_api_key)
         response = await loop.run_in_executor(
             None,
             lambda: client.models.generate_content(model=AI_MODEL_NAME, contents=full_prompt)
         )
         if not response or not getattr(response, "text", None):
-            logger.warning(f"LLM returned no text for user {user_id}. Prompt may have been blocked.")
+            logger.warning("LLM returned no text for user %s. Prompt may have been blocked.", user_id)
+            tenant.metrics["ai_errors"] += 1
             return "Infinity encountered an issue while processing your message. Please try again in a moment. CWWWW will be back online soon to reply you."
         
         ai_text = response.text
-        logger.info(f"Successfully generated AI reply for user {user_id}")
+        logger.info("Successfully generated AI reply for user %s", user_id, extra=SAMPLED)
         
         # Add AI response to conversation history
-        add_to_conversation_history(user_id, YOUR_NAME, ai_text)
+        add_to_conversation_history(user_id, tenant.your_name, ai_text)
         
         return ai_text.strip()
     except Exception as e:
-        logger.error(f"Error generating AI reply for user {user_id}: {e}", exc_info=True)
+        logger.error("Error generating AI reply for user %s: %s", user_id, e, exc_info=True)
+        tenant.metrics["ai_errors"] += 1
         return "Infinity encountered an issue while processing your message. Please try again in a moment. CWWWW will be back online soon to reply you."
 
 
+async def keep_typing(
+    bot, chat_id: int, interval: float = TYPING_REFRESH_SECONDS, max_seconds: float = TYPING_MAX_SECONDS
+) -> None:
+    """Resend the typing action every ``interval`` seconds until cancelled or ``max_seconds`` pass"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_seconds
+    while True:
+        await asyncio.sleep(interval)
+        if loop.time() >= deadline:
+            return
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except TelegramError as e:
+            logger.debug(f"Could not refresh typing action in chat {chat_id}: {e}")
+
+async def stop_typing(typing_task: Optional[asyncio.Task]) -> None:
+    """Cancel a keep_typing task and wait until it has stopped"""
+    if typing_task is None or typing_task.done():
+        return
+    typing_task.cancel()
+    try:
+        await typing_task
+    except asyncio.CancelledError:
+        pass
+
 async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user and update.effective_user.id == context.bot.id:
         logger.debug("Ignoring message from bot itself in private chat.")
@@ -303,44 +380,53 @@ async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_T
         logger.warning("Received update without message, user, or chat in private handler.")
         return
 
+    tenant = current_tenant()
     user = update.effective_user
     chat_id = update.effective_chat.id
     user_id_str = str(user.id)
     message = update.message
     message_text = message.text or message.caption or ""
+    bind_log_context(user_id=user.id)
 
     await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
 
     topic_id = get_user_topic_id(user.id)
     is_new_user = False
+    if topic_id:
+        bind_log_context(topic_id=topic_id)
 
     if not topic_id:
-        logger.info(f"Received first message from new user {user.id} ({user.first_name} @{user.username}). Creating topic.")
+        logger.info("Received first message from new user %s (%s @%s). Creating topic.", user.id, user.first_name, user.username)
         topic_title = create_topic_title(user)
         try:
             created_topic = await context.bot.create_forum_topic(
-                chat_id=SUPPORT_GROUP_ID, name=topic_title
+                chat_id=tenant.support_group_id, name=topic_title
             )
             topic_id = created_topic.message_thread_id
             is_new_user = True
-            logger.info(f"Created topic {topic_id} ('{topic_title}') for user {user.id}")
+            bind_log_context(topic_id=topic_id)
+            logger.info("Created topic %s ('%s') for user %s", topic_id, topic_title, user.id)
 
-            _user_topic_map["user_mappings"][user_id_str] = {
+            tenant.user_topic_map["user_mappings"][user_id_str] = {
                 "topic_id": topic_id,
                 "username": user.username,
                 "first_name": user.first_name,
                 "last_name": user.last_name,
                 "ai_mode_enabled": True
             }
+            tenant.user_contexts.pop(user.id, None)
             save_data()
+            tenant.metrics["new_topics"] += 1
 
-            await context.bot.forward_message(
-                chat_id=SUPPORT_GROUP_ID,
+            forwarded = await context.bot.forward_message(
+                chat_id=tenant.support_group_id,
                 from_chat_id=chat_id,
                 message_id=message.message_id,
                 message_thread_id=topic_id,
             )
-            logger.info(f"Forwarded first message from user {user.id} to new topic {topic_id}")
+            tenant.message_index.add(chat_id, message.message_id, tenant.support_group_id, topic_id, forwarded.message_id)
+            tenant.metrics["relayed"] += 1
+            logger.info("Forwarded first message from user %s to new topic %s", user.id, topic_id)
 
             if message_text == '/start':
                 await update.message.reply_text("Hi @{user.username}! I\'m CW. This is my private messageing bot. It is based on AI. I will soon to check and reply your message.```\n\n✨ Infinity is Taking Over```\nHello! I'm Infinity.",
@@ -348,90 +434,147 @@ async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_T
             )
 
         except TelegramError as e:
-            logger.error(f"Failed to create topic or forward first message for user {user.id}: {e}")
+            logger.error("Failed to create topic or forward first message for user %s: %s", user.id, e)
             try:
                 await update.message.reply_text(
                     "Sorry, there was an error setting up your chat. Please try sending your message again."
                 )
             except Exception as inner_e:
-                logger.error(f"Failed to notify user {user.id} about topic creation error: {inner_e}")
+                logger.error("Failed to notify user %s about topic creation error: %s", user.id, inner_e)
             return
         except Exception as e:
-            logger.exception(f"Unexpected error handling new user {user.id}")
+            logger.exception("Unexpected error handling new user %s", user.id)
             try:
                 await update.message.reply_text("An unexpected error occurred. Please try sending your message again.")
             except Exception as inner_e:
-                logger.error(f"Failed to notify user {user.id} about unexpected new user error: {inner_e}")
+                logger.error("Failed to notify user %s about unexpected new user error: %s", user.id, inner_e)
             return
     else:
-        logger.info(f"Relaying message from known user {user.id} to topic {topic_id}")
+        logger.info("Relaying message from known user %s to topic %s", user.id, topic_id, extra=SAMPLED)
         try:
-            await context.bot.forward_message(
-                chat_id=SUPPORT_GROUP_ID,
+            forwarded = await context.bot.forward_message(
+                chat_id=tenant.support_group_id,
                 from_chat_id=chat_id,
                 message_id=message.message_id,
                 message_thread_id=topic_id,
             )
+            tenant.message_index.add(chat_id, message.message_id, tenant.support_group_id, topic_id, forwarded.message_id)
+            tenant.metrics["relayed"] += 1
         except TelegramError as e:
-            logger.error(f"Failed to forward message from user {user.id} to topic {topic_id}: {e}")
+            logger.error("Failed to forward message from user %s to topic %s: %s", user.id, topic_id, e)
             try:
                 await update.message.reply_text(
                     "Sorry, there was an error processing your message. Please try again."
                 )
             except Exception as inner_e:
-                logger.error(f"Failed to notify user {user.id} about forwarding error: {inner_e}")
+                logger.error("Failed to notify user %s about forwarding error: %s", user.id, inner_e)
             return
         except Exception as e:
-            logger.exception(f"Unexpected error forwarding message for user {user.id}")
+            logger.exception("Unexpected error forwarding message for user %s", user.id)
             try:
                 await update.message.reply_text("An unexpected error occurred. Please try again.")
             except Exception as inner_e:
-                logger.error(f"Failed to notify user {user.id} about unexpected forwarding error: {inner_e}")
+                logger.error("Failed to notify user %s about unexpected forwarding error: %s", user.id, inner_e)
             return
 
+    # Record on receipt, so history stays in arrival order however AI replies are scheduled
+    history = get_conversation_history(user.id)
+    if message_text:
+        add_to_conversation_history(user.id, "user", message_text)
+
     if topic_id and is_ai_mode_enabled(user.id):
-        ai_reply_text = await generate_ai_reply(message_text, user.id)
-        if ai_reply_text:
+        # Media without a caption and bots without a Gemini key get no AI reply,
+        # so they must not use up quota or show "typing"
+        if not message_text:
+            logger.info("No text in message from user %s, not generating AI reply.", user.id, extra=SAMPLED)
+            return
+        if not tenant.gemini_api_key:
+            logger.warning("Skipping AI reply for user %s: Gemini API key not configured.", user.id)
+            return
+        if not lifecycle.is_accepting():
+            logger.info("Shutting down, not generating AI reply for user %s.", user.id)
+            return
+        user_key = (tenant.name, user.id)
+        user_tags, _ = get_user_context(user.id)
+        exhausted = quotas.try_consume(user_key, user_tags)
+        if exhausted:
+            logger.info("AI quota (%s) exhausted for user %s; message forwarded without AI reply.", exhausted, user.id)
+            tenant.metrics["quota_limited"] += 1
+            return
+        # Keep "typing" visible while the reply waits for a worker and the model
+        typing_task = asyncio.ensure_future(keep_typing(context.bot, chat_id))
+        queued = _ai_scheduler.submit(
+            user_key,
+            lambda: reply_with_ai(context.bot, user, chat_id, message_text, history, topic_id, typing_task),
+            on_drop=typing_task.cancel
+        )
+        if not queued:
+            await stop_typing(typing_task)
+            quotas.refund(user_key)
+            logger.info("Too many pending AI replies for user %s; message forwarded without AI reply.", user.id)
+    elif topic_id and not is_ai_mode_enabled(user.id):
+        logger.info("AI Mode is disabled for user %s, not generating AI reply.", user.id, extra=SAMPLED)
+
+async def reply_with_ai(
+    bot,
+    user: User,
+    chat_id: int,
+    message_text: str,
+    history: List[Dict[str, str]],
+    topic_id: int,
+    typing_task: Optional[asyncio.Task] = None,
+) -> None:
+    """Generate an AI reply and send it to the user and the topic"""
+    tenant = current_tenant()
+    try:
+        ai_reply_text = await generate_ai_reply(message_text, user.id, history)
+    finally:
+        # Stop before sending so a late typing action does not outlive the reply
+        await stop_typing(typing_task)
+    if ai_reply_text is None:
+        # Skipped, e.g. AI mode was turned off while the reply was queued
+        quotas.refund((tenant.name, user.id))
+    if ai_reply_text:
+        try:
+            await send_chunks(
+                bot,
+                chat_id,
+                format_user_reply(ai_reply_text),
+                parse_mode=ParseMode.MARKDOWN
+            )
+            logger.info("Sent AI reply to user %s", user.id, extra=SAMPLED)
+            tenant.metrics["ai_replies"] += 1
+
+            current_ai_state = True
+            keyboard = get_aimode_toggle_keyboard(user.id, current_ai_state)
+            await send_chunks(
+                bot,
+                tenant.support_group_id,
+                format_topic_copy(ai_reply_text),
+                reply_markup=keyboard,
+                message_thread_id=topic_id,
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+            logger.info("Sent AI reply copy and controls to topic %s", topic_id, extra=SAMPLED)
+        except TelegramError as e:
+            logger.error("Error sending AI reply or copy for user %s / topic %s: %s", user.id, topic_id, e)
             try:
-                ai_message_to_user = await context.bot.send_message(
-                    chat_id=chat_id,
-                    text="```\n✨ Infinity is Taking Over```\n" + ai_reply_text,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                logger.info(f"Sent AI reply to user {user.id}")
-
-                current_ai_state = True
-                keyboard = get_aimode_toggle_keyboard(user.id, current_ai_state)
-                base_text = "🤖 *AI Response:*\n---\n" + ai_reply_text + "\n---"
-                escaped_text = escape_markdown_v2(base_text)
-                await context.bot.send_message(
-                    chat_id=SUPPORT_GROUP_ID,
+                escaped_error = escape_markdown_v2(str(e))
+                await bot.send_message(
+                    chat_id=tenant.support_group_id,
                     message_thread_id=topic_id,
-                    text=escaped_text,
-                    reply_markup=keyboard,
+                    text=escape_markdown_v2(f"⚠️ Error sending AI reply to user {user.id} or posting copy here.") + f"\n`{escaped_error}`",
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
-                logger.info(f"Sent AI reply copy and controls to topic {topic_id}")
-            except TelegramError as e:
-                logger.error(f"Error sending AI reply or copy for user {user.id} / topic {topic_id}: {e}")
-                try:
-                    escaped_error = escape_markdown_v2(str(e))
-                    await context.bot.send_message(
-                        chat_id=SUPPORT_GROUP_ID,
-                        message_thread_id=topic_id,
-                        text=f"⚠️ Error sending AI reply to user {user.id} or posting copy here.\n`{escaped_error}`",
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                except Exception:
-                    pass
-            except Exception as e:
-                logger.exception(f"Unexpected error sending AI reply/copy for user {user.id} / topic {topic_id}")
-    elif topic_id and not is_ai_mode_enabled(user.id):
-        logger.info(f"AI Mode is disabled for user {user.id}, not generating AI reply.")
+            except Exception:
+                pass
+        except Exception as e:
+            logger.exception("Unexpected error sending AI reply/copy for user %s / topic %s", user.id, topic_id)
 
 async def handle_topic_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant = current_tenant()
     if (not update.message or not update.message.is_topic_message or not update.message.message_thread_id
-        or not update.effective_chat or update.effective_chat.id != SUPPORT_GROUP_ID
+        or not update.effective_chat or update.effective_chat.id != tenant.support_group_id
         or not update.effective_user):
         return
 
@@ -448,29 +591,34 @@ async def handle_topic_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     topic_id = update.message.message_thread_id
     message = update.message
     admin_user = update.effective_user
+    bind_log_context(topic_id=topic_id)
 
-    logger.info(f"Received manual reply in topic {topic_id} from admin {admin_user.id}")
+    logger.info("Received manual reply in topic %s from admin %s", topic_id, admin_user.id, extra=SAMPLED)
 
     target_user_id = get_user_id_from_topic(topic_id)
     if target_user_id:
-        logger.info(f"Relaying manual reply from topic {topic_id} to user {target_user_id}")
+        bind_log_context(user_id=target_user_id)
+        logger.info("Relaying manual reply from topic %s to user %s", topic_id, target_user_id, extra=SAMPLED)
         
         message_text = message.text or message.caption or ""
         if message_text:
-            add_to_conversation_history(target_user_id, YOUR_NAME, message_text)
+            add_to_conversation_history(target_user_id, tenant.your_name, message_text)
             
         try:
-            await context.bot.forward_message(
+            forwarded = await context.bot.forward_message(
                 chat_id=target_user_id,
-                from_chat_id=SUPPORT_GROUP_ID,
+                from_chat_id=tenant.support_group_id,
                 message_id=message.message_id,
             )
+            tenant.message_index.add(tenant.support_group_id, message.message_id, target_user_id, None, forwarded.message_id)
+            tenant.metrics["admin_replies"] += 1
         except TelegramError as e:
             logger.error(f"Failed to forward manual reply from topic {topic_id} to user {target_user_id}: {e}")
             try:
                 escaped_error = escape_markdown_v2(str(e))
                 await message.reply_text(
-                    f"⚠️ Error: Could not forward message to user `{target_user_id}`. Reason: `{escaped_error}`",
+                    escape_markdown_v2("⚠️ Error: Could not forward message to user ") + f"`{target_user_id}`"
+                    + escape_markdown_v2(". Reason: ") + f"`{escaped_error}`",
                     quote=True,
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
@@ -480,7 +628,7 @@ async def handle_topic_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
             logger.exception(f"Unexpected error forwarding manual reply from topic {topic_id} to user {target_user_id}")
             try:
                 await message.reply_text(
-                    f"⚠️ Unexpected Error forwarding message to user `{target_user_id}`.",
+                    escape_markdown_v2("⚠️ Unexpected Error forwarding message to user ") + f"`{target_user_id}`\\.",
                     quote=True,
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
@@ -489,6 +637,91 @@ async def handle_topic_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         logger.warning(f"Received manual reply in topic {topic_id}, but no user found associated with this topic.")
 
+async def handle_private_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mirror an edited user message into the topic as a reply to the forwarded copy"""
+    edited = update.edited_message
+    if not edited or not update.effective_user or not update.effective_chat:
+        return
+
+    user = update.effective_user
+    link = current_tenant().message_index.get_target(update.effective_chat.id, edited.message_id)
+    if not link:
+        logger.info("No forwarded copy known for edited message %s from user %s", edited.message_id, user.id, extra=SAMPLED)
+        return
+
+    target_chat_id, topic_id, forwarded_id = link
+    new_text = edited.text or edited.caption or ""
+    try:
+        await context.bot.send_message(
+            chat_id=target_chat_id,
+            message_thread_id=topic_id or None,
+            reply_to_message_id=forwarded_id,
+            text=f"✏️ User edited this message:\n{new_text}" if new_text else "✏️ User edited this message.",
+        )
+        logger.info("Mirrored edit of message %s from user %s to topic %s", edited.message_id, user.id, topic_id, extra=SAMPLED)
+    except TelegramError as e:
+        logger.error("Failed to mirror edit of message %s from user %s to topic %s: %s", edited.message_id, user.id, topic_id, e)
+
+async def handle_topic_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mirror an edited admin reply to the user as a reply to the relayed copy"""
+    edited = update.edited_message
+    if not edited or not update.effective_user or update.effective_user.id == context.bot.id:
+        return
+
+    tenant = current_tenant()
+    link = tenant.message_index.get_target(tenant.support_group_id, edited.message_id)
+    if not link:
+        logger.info("No relayed copy known for edited topic message %s", edited.message_id, extra=SAMPLED)
+        return
+
+    target_user_id, _, forwarded_id = link
+    new_text = edited.text or edited.caption or ""
+    try:
+        await context.bot.send_message(
+            chat_id=target_user_id,
+            reply_to_message_id=forwarded_id,
+            text=f"✏️ Edited:\n{new_text}" if new_text else "✏️ This message was edited.",
+        )
+        logger.info("Mirrored edit of topic message %s to user %s", edited.message_id, target_user_id, extra=SAMPLED)
+    except TelegramError as e:
+        logger.error("Failed to mirror edit of topic message %s to user %s: %s", edited.message_id, target_user_id, e)
+
+async def handle_delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /delete replies in a topic by removing the relayed copy of the replied-to message"""
+    message = update.message
+    if not message or not message.reply_to_message:
+        if message:
+            await message.reply_text("Reply to a relayed message with /delete to remove its copy.")
+        return
+
+    tenant = current_tenant()
+    message_index = tenant.message_index
+    support_group_id = tenant.support_group_id
+    target = message.reply_to_message
+    link = message_index.get_target(support_group_id, target.message_id)
+    if link:
+        # Admin reply relayed to the user: delete the user's copy
+        source_chat_id, source_message_id = support_group_id, target.message_id
+        delete_chat_id, delete_message_id = link[0], link[2]
+    else:
+        # Forwarded user message: delete the copy in this topic
+        source = message_index.get_source(support_group_id, target.message_id)
+        if not source:
+            await message.reply_text("This message has no known relayed copy.")
+            return
+        source_chat_id, source_message_id = source
+        delete_chat_id, delete_message_id = support_group_id, target.message_id
+
+    try:
+        await context.bot.delete_message(chat_id=delete_chat_id, message_id=delete_message_id)
+        message_index.remove(source_chat_id, source_message_id)
+        logger.info(f"Deleted relayed message {delete_message_id} in chat {delete_chat_id} on request of {update.effective_user.id}")
+        if delete_chat_id != support_group_id:
+            await message.reply_text("Deleted the copy sent to the user.")
+    except TelegramError as e:
+        logger.error(f"Failed to delete relayed message {delete_message_id} in chat {delete_chat_id}: {e}")
+        await message.reply_text(f"Could not delete the message: {e}")
+
 async def handle_aimode_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     if not query or not query.data or not query.message:
@@ -546,7 +779,8 @@ async def handle_aimode_toggle(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def handle_tag_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /tag commands for adding, removing, and listing tags for users"""
-    if not update.effective_chat or update.effective_chat.id != SUPPORT_GROUP_ID:
+    tenant = current_tenant()
+    if not update.effective_chat or update.effective_chat.id != tenant.support_group_id:
         logger.warning(f"Tag command attempted outside support group by {update.effective_user.id if update.effective_user else 'unknown'}")
         return
     
@@ -570,83 +804,335 @@ async def handle_tag_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if action == "add" and len(args) >= 4:
         username = args[2]
         tag = args[3]
-        success, message = add_tag_by_username(username, tag)
+        success, message = add_tag_by_username(username, tag, tenant.data_file_path, tenant.user_topic_map)
+        if success:
+            save_data()
         await update.message.reply_text(message)
     
     elif action == "remove" and len(args) >= 4:
         username = args[2]
         tag = args[3]
-        success, message = remove_tag_by_username(username, tag)
+        success, message = remove_tag_by_username(username, tag, tenant.data_file_path, tenant.user_topic_map)
+        if success:
+            save_data()
         await update.message.reply_text(message)
     
     elif action == "list" and len(args) >= 3:
         username = args[2]
-        success, message, _ = list_tags_by_username(username)
+        success, message, _ = list_tags_by_username(username, tenant.data_file_path, tenant.user_topic_map)
         await update.message.reply_text(message)
     
     else:
         await update.message.reply_text("Usage:\n/tag add username tag\n/tag remove username tag\n/tag list username")
 
+async def handle_quota_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /quota commands for showing and resetting AI reply quotas"""
+    message = update.message
+    if not message or not message.text:
+        return
+
+    tenant = current_tenant()
+    usage = "Usage:\n/quota [username|user_id]\n/quota reset [username|user_id|all|global]\n(Inside a user's topic the user can be omitted)"
+    args = message.text.split()[1:]
+    reset = bool(args) and args[0].lower() == "reset"
+    if reset:
+        args = args[1:]
+
+    if reset and args and args[0].lower() == "all":
+        quotas.reset_all_quotas(tenant.name)
+        logger.info(f"All AI quotas of {tenant.name} reset by {update.effective_user.id}")
+        await message.reply_text("Reset all AI quotas of this bot.")
+        return
+
+    if reset and args and args[0].lower() == "global":
+        quotas.reset_global_quota()
+        logger.info(f"Global AI quota reset by {update.effective_user.id}")
+        await message.reply_text("Reset the global AI quota shared by all bots.")
+        return
+
+    from tag_commands import get_tags_by_user_id, get_user_id_from_username
+    if args:
+        target = args[0].lstrip("@")
+        if target.isdigit():
+            user_id = int(target)
+        else:
+            user_id_str = get_user_id_from_username(tenant.user_topic_map, target)
+            user_id = int(user_id_str) if user_id_str else None
+    elif message.is_topic_message and message.message_thread_id:
+        user_id = get_user_id_from_topic(message.message_thread_id)
+    else:
+        user_id = None
+
+    if not user_id:
+        await message.reply_text(usage)
+        return
+
+    if reset:
+        quotas.reset_quota((tenant.name, user_id))
+        logger.info(f"AI quota for user {user_id} reset by {update.effective_user.id}")
+        await message.reply_text(f"Reset AI quota for user {user_id}.")
+    else:
+        status = quotas.describe_quota((tenant.name, user_id), get_tags_by_user_id(user_id, tenant.data_file_path, tenant.user_topic_map))
+        pending = _ai_scheduler.pending((tenant.name, user_id)) if _ai_scheduler else 0
+        await message.reply_text(f"{status}\nQueued AI replies: {pending}")
+
+def get_topic_link(topic_id: int) -> str:
+    """Link to a topic of the support group; supergroup ids are -100 followed by the internal id"""
+    chat_id = str(current_tenant().support_group_id)
+    internal_id = chat_id[4:] if chat_id.startswith("-100") else chat_id.lstrip("-")
+    return f"https://t.me/c/{internal_id}/{topic_id}"
+
+def format_age(seconds: float) -> str:
+    if seconds < 60:
+        return "just now"
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return f"{int(seconds // size)}{unit} ago"
+
+async def handle_search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /search <terms> by listing users whose stored history mentions every term, newest first"""
+    message = update.message
+    if not message or not message.text:
+        return
+    query = message.text.partition(" ")[2].strip()
+    terms = tokenize(query)
+    if not terms:
+        await message.reply_text("Usage: /search terms")
+        return
+
+    tenant = current_tenant()
+    results = tenant.search_index.search(query)
+    logger.info("Search for %s by %s matched %s user(s)", sorted(terms), update.effective_user.id, len(results), extra=SAMPLED)
+    if not results:
+        await message.reply_text(f"No conversations mention: {query}")
+        return
+
+    now = time.time()
+    lines = [f"Conversations mentioning: {query}"]
+    for rank, (user_id, last_said) in enumerate(results, 1):
+        user_data = get_user_data(user_id) or {}
+        display_name = " ".join(filter(None, (user_data.get("first_name"), user_data.get("last_name")))) or str(user_id)
+        username = f" (@{user_data['username']})" if user_data.get("username") else ""
+        age = format_age(now - last_said) if last_said else "earlier"
+        lines.append(f"\n{rank}. {display_name}{username}, {age}")
+        if user_data.get("topic_id"):
+            lines.append(get_topic_link(user_data["topic_id"]))
+        snippet = next(
+            (entry.get("message", "") for entry in reversed(tenant.conversation_history.get(str(user_id), []))
+             if matches_all(entry.get("message", ""), terms)),
+            ""
+        )
+        if snippet:
+            lines.append(f"\"{snippet[:100]}{'…' if len(snippet) > 100 else ''}\"")
+    await message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+async def handle_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /stats by showing this bot's counters since startup"""
+    if not update.message:
+        return
+    tenant = current_tenant()
+    metrics = tenant.metrics
+    lines = [f"Stats for {tenant.name} since startup:"]
+    for name in ("updates", "relayed", "new_topics", "admin_replies", "ai_replies", "ai_errors", "quota_limited"):
+        lines.append(f"{name.replace('_', ' ').capitalize()}: {metrics[name]}")
+    lines.append(f"Known users: {len(tenant.user_topic_map['user_mappings'])}")
+    await update.message.reply_text("\n".join(lines))
+
+async def start_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Bind the bot's tenant and a correlation id, and drop updates handled before a restart"""
+    tenant = context.application.bot_data["tenant"]
+    set_current_tenant(tenant)
+    start_update_context(update.update_id, tenant=tenant.name)
+    if lifecycle.is_already_processed(tenant.name, update.update_id):
+        logger.info("Skipping update %s: already processed before restart.", update.update_id, extra=SAMPLED)
+        raise ApplicationHandlerStop
+    tenant.metrics["updates"] += 1
+
+async def record_processed_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    lifecycle.record_processed(current_tenant().name, update.update_id)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Exception while handling an update:", exc_info=context.error)
 
 async def post_init(application: Application) -> None:
+    tenant = current_tenant()
+    support_group_id = tenant.support_group_id
     try:
         bot_user = await application.bot.get_me()
-        logger.info(f"Bot started: {bot_user.first_name} (@{bot_user.username} ID: {bot_user.id})")
+        logger.info(f"Bot started for {tenant.name}: {bot_user.first_name} (@{bot_user.username} ID: {bot_user.id})")
         application.bot_data["bot_id"] = bot_user.id
         try:
-            chat_member = await application.bot.get_chat_member(SUPPORT_GROUP_ID, bot_user.id)
+            chat_member = await application.bot.get_chat_member(support_group_id, bot_user.id)
             if chat_member.status not in ['administrator', 'member']:
-                logger.error(f"Bot is not a member or admin in the support group {SUPPORT_GROUP_ID}. Status: {chat_member.status}")
+                logger.error(f"Bot is not a member or admin in the support group {support_group_id}. Status: {chat_member.status}")
             else:
-                logger.info(f"Bot is '{chat_member.status}' in support group {SUPPORT_GROUP_ID}.")
+                logger.info(f"Bot is '{chat_member.status}' in support group {support_group_id}.")
         except TelegramError as e:
-            logger.error(f"Could not verify bot status in support group {SUPPORT_GROUP_ID}: {e}")
+            logger.error(f"Could not verify bot status in support group {support_group_id}: {e}")
     except Exception as e:
         logger.exception("Error during post_init get_me or group check.")
-    if not GEMINI_API_KEY:
-        logger.warning("Reminder: API key is missing or invalid. AI features are disabled.")
+    if not tenant.gemini_api_key:
+        logger.warning(f"Reminder: API key is missing or invalid for {tenant.name}. AI features are disabled.")
 
-def main() -> None:
-    load_data()
-    builder = ApplicationBuilder().token(BOT_TOKEN)
-    application = builder.post_init(post_init).build()
+async def drain_ai_replies() -> None:
+    """Let queued AI replies finish until the shutdown deadline, then drop the rest"""
+    lifecycle.begin_shutdown()
+    if _ai_scheduler is None:
+        return
+    _ai_scheduler.close()
+    lifecycle.track(_ai_scheduler.join(), name="ai_scheduler_join")
+    await lifecycle.drain()
+    await _ai_scheduler.stop()
+
+async def handle_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /start command for initializing user interaction"""
+    user = update.effective_user
+    if not user:
+        logger.warning("Start command received without user information")
+        return
+
+    await update.message.reply_text(
+        f"Hi {user.first_name}! What is on your mind? I will forward your message to the Admin.",
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+def build_application(tenant: Tenant, request: SharedHTTPXRequest) -> Application:
+    """Build the bot of one tenant on the shared connection pool"""
+    application = ApplicationBuilder().token(tenant.bot_token).request(request).get_updates_request(request).build()
+    application.bot_data["tenant"] = tenant
+    support_group = filters.Chat(chat_id=tenant.support_group_id)
+
+    application.add_handler(TypeHandler(Update, start_update), group=-1)
+    application.add_handler(TypeHandler(Update, record_processed_update), group=1)
 
     application.add_handler(MessageHandler(
-        filters.ChatType.PRIVATE & (~filters.COMMAND),
+        filters.ChatType.PRIVATE & filters.UpdateType.MESSAGE & (~filters.COMMAND),
         handle_private_message
     ))
     application.add_handler(MessageHandler(
-        filters.Chat(chat_id=SUPPORT_GROUP_ID) & filters.UpdateType.MESSAGE & filters.IS_TOPIC_MESSAGE,
+        filters.ChatType.PRIVATE & filters.UpdateType.EDITED_MESSAGE,
+        handle_private_edit
+    ))
+    application.add_handler(MessageHandler(
+        support_group & filters.UpdateType.MESSAGE & filters.IS_TOPIC_MESSAGE & (~filters.COMMAND),
         handle_topic_reply
     ))
+    application.add_handler(MessageHandler(
+        support_group & filters.UpdateType.EDITED_MESSAGE & filters.IS_TOPIC_MESSAGE,
+        handle_topic_edit
+    ))
     application.add_handler(CallbackQueryHandler(
         handle_aimode_toggle,
         pattern=r"^aimode_toggle_"
     ))
-    application.add_handler(CommandHandler(
-        "tag",
-        handle_tag_command,
-        filters=filters.Chat(chat_id=SUPPORT_GROUP_ID)
-    ))
-    async def handle_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Handle /start command for initializing user interaction"""
-        user = update.effective_user
-        if not user:
-            logger.warning("Start command received without user information")
-            return
-    
-        await update.message.reply_text(
-            f"Hi {user.first_name}! What is on your mind? I will forward your message to the Admin.",
-            parse_mode=ParseMode.MARKDOWN
-        )
-    
-
+    application.add_handler(CommandHandler("tag", handle_tag_command, filters=support_group))
+    application.add_handler(CommandHandler("quota", handle_quota_command, filters=support_group))
+    application.add_handler(CommandHandler("delete", handle_delete_command, filters=support_group))
+    application.add_handler(CommandHandler("stats", handle_stats_command, filters=support_group))
+    application.add_handler(CommandHandler("search", handle_search_command, filters=support_group))
     application.add_handler(CommandHandler("start", handle_start_command))
     application.add_error_handler(error_handler)
+    return application
+
+async def run_tenants(tenants: List[Tenant]) -> None:
+    """Poll every tenant's bot in one event loop until SIGINT/SIGTERM, then shut down gracefully"""
+    global _ai_scheduler
+    request = SharedHTTPXRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE)
+    # Rotate over tenants first, then over users within each tenant
+    _ai_scheduler = FairScheduler(group_of=lambda user_key: user_key[0])
+    quotas.configure_tenants(tenant.name for tenant in tenants)
+    _ai_scheduler.start()
+    lifecycle.start_checkpoints()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Not supported on Windows; KeyboardInterrupt still ends asyncio.run
+            pass
+
+    running = []
+    lifecycle.start_resume_window()
+    try:
+        for tenant in tenants:
+            application = build_application(tenant, request)
+            with tenant_scope(tenant):
+                try:
+                    await application.initialize()
+                    await post_init(application)
+                    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                    await application.start()
+                except Exception:
+                    logger.exception(f"Failed to start bot for {tenant.name}; skipping it.")
+                    if application.updater.running:
+                        await application.updater.stop()
+                    await application.shutdown()
+                    continue
+            running.append(application)
+        if not running:
+            logger.error("No bot could be started.")
+            return
+        logger.info(f"Polling {len(running)} bot(s)...")
+        await stop_event.wait()
+    finally:
+        # Stop fetching first, then let each bot finish the updates it already
+        # fetched while AI work is still accepted, so every checkpointed update
+        # got its AI reply queued. Only then drain the AI replies.
+        for application in running:
+            try:
+                await application.updater.stop()
+            except Exception:
+                logger.exception(f"Error stopping polling for {application.bot_data['tenant'].name}")
+        for application in running:
+            try:
+                await application.stop()
+            except Exception:
+                logger.exception(f"Error stopping bot for {application.bot_data['tenant'].name}")
+        await drain_ai_replies()
+        for application in running:
+            try:
+                await application.shutdown()
+            except Exception:
+                logger.exception(f"Error shutting down bot for {application.bot_data['tenant'].name}")
+        await lifecycle.final_flush()
+        await request.close()
+        for tenant in tenants:
+            if tenant.message_index is not None:
+                tenant.message_index.close()
+
+def snapshot_tenant_state(tenant: Tenant, snapshot) -> Tuple[str, bytes]:
+    with tenant_scope(tenant):
+        return snapshot()
+
+def main() -> None:
+    default_tenant = Tenant(
+        name=DEFAULT_TENANT_NAME,
+        bot_token=BOT_TOKEN,
+        support_group_id=SUPPORT_GROUP_ID,
+        your_name=YOUR_NAME,
+        base_prompt=GEMINI_BASE_PROMPT,
+        gemini_api_key=GEMINI_API_KEY,
+    )
+    tenants = load_tenants(default_tenant, GEMINI_BASE_PROMPT_TEMPLATE)
+    lifecycle.load_checkpoint(DEFAULT_TENANT_NAME)
+    for tenant in tenants:
+        if tenant.data_dir:
+            os.makedirs(tenant.data_dir, exist_ok=True)
+        with tenant_scope(tenant):
+            load_data()
+        tenant.message_index = MessageIndex(tenant.message_index_file_path)
+        lifecycle.register_flusher(
+            tenant.state_key("user_topic_map"),
+            partial(snapshot_tenant_state, tenant, snapshot_data)
+        )
+        lifecycle.register_flusher(
+            tenant.state_key("conversation_history"),
+            partial(snapshot_tenant_state, tenant, snapshot_conversation_history)
+        )
     logger.info("Starting bot polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    asyncio.run(run_tenants(tenants))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,14 +1,63 @@
 import json
 import logging
-from typing import Dict, Any
+import os
+import tempfile
+from typing import Dict, Any, Optional
 
 logger = logging.getLogger(__name__)
 
 DATA_FILE_PATH = "user_topic_map.json"
 
-def load_data() -> Dict[str, Any]:
+def serialize_json(data: Any, indent: Optional[int] = 4) -> bytes:
+    """Encode data the way it is stored on disk.
+
+    indent=None is several times faster, since json only uses its C encoder
+    for compact output.
+    """
+    return json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")
+
+def atomic_write_json(path: str, data: Any) -> None:
+    atomic_write_bytes(path, serialize_json(data))
+
+def atomic_write_bytes(path: str, payload: bytes) -> None:
+    """Write bytes to a unique temp file, fsync it, and rename it over path.
+
+    The containing directory is fsynced too, so the rename survives a crash.
+    Errors are raised to the caller. This blocks on the disk; from the event
+    loop run it in an executor.
+    """
+    parent_dir = os.path.dirname(path) or "."
+    os.makedirs(parent_dir, exist_ok=True)
+    fd, temp_file_path = tempfile.mkstemp(dir=parent_dir, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        # mkstemp creates 0600 files; keep the mode of the file being replaced
+        os.chmod(temp_file_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_file_path)
+        except OSError:
+            pass
+        raise
+    try:
+        dir_fd = os.open(parent_dir, os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on Windows
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def load_data(path: Optional[str] = None) -> Dict[str, Any]:
     try:
-        with open(DATA_FILE_PATH, "r", encoding="utf-8") as f:
+        with open(path or DATA_FILE_PATH, "r", encoding="utf-8") as f:
             data = json.load(f)
             if "username_tags" not in data:
                 data["username_tags"] = {}
@@ -20,10 +69,9 @@ def load_data() -> Dict[str, Any]:
         logger.error(f"Error loading data file: {e}")
         return {"support_group_id": 0, "user_mappings": {}, "username_tags": {}}
 
-def save_data(data: Dict[str, Any]) -> bool:
+def save_data(data: Dict[str, Any], path: Optional[str] = None) -> bool:
     try:
-        with open(DATA_FILE_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        atomic_write_json(path or DATA_FILE_PATH, data)
         return True
     except Exception as e:
         logger.error(f"Error saving data file: {e}")
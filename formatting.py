@@ -0,0 +1,118 @@
+from typing import Callable, List, Optional
+
+# Telegram rejects messages longer than this many UTF-16 code units
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+USER_REPLY_HEADER = "```\n✨ Infinity is Taking Over```\n"
+
+_MARKDOWN_V2_TABLE = str.maketrans({char: f"\\{char}" for char in "_*[]()~`>#+-=|{}.!\\"})
+_FENCE = "```"
+_FENCE_CLOSE = "\n```"
+
+
+def escape_markdown_v2(text: str) -> str:
+    """Escape MarkdownV2 reserved characters in a single pass: _ * [ ] ( ) ~ ` > # + - = | { } . ! \\"""
+    return text.translate(_MARKDOWN_V2_TABLE)
+
+
+def utf16_len(text: str) -> int:
+    """Length of text as Telegram counts it"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def escaped_len(text: str) -> int:
+    """Length of text once escaped for MarkdownV2"""
+    return utf16_len(escape_markdown_v2(text))
+
+
+def _split_long_line(line: str, budget: int, measure: Callable[[str], int]) -> List[str]:
+    """Cut a line that does not fit in one message, preferring whitespace"""
+    pieces = []
+    while measure(line) > budget:
+        size = 0
+        cut = 0
+        last_space = 0
+        for i, char in enumerate(line):
+            size += measure(char)
+            if size > budget:
+                break
+            cut = i + 1
+            if char.isspace():
+                last_space = i + 1
+        if last_space:
+            cut = last_space
+        pieces.append(line[:max(cut, 1)])
+        line = line[max(cut, 1):]
+    if line:
+        pieces.append(line)
+    return pieces
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT, measure: Callable[[str], int] = utf16_len) -> List[str]:
+    """Split text into chunks whose measured size fits in ``limit``.
+
+    Splits between lines where possible, then on whitespace, and cuts inside
+    a word only as a last resort. A code fence that is open at a split is
+    closed at the end of the chunk and reopened at the start of the next one.
+    ``measure`` must be additive over concatenation, like ``utf16_len`` and
+    ``escaped_len``. Split the raw text and escape each chunk afterwards, so
+    escapes are never cut in half.
+    """
+    if measure(text) <= limit:
+        return [text]
+
+    chunks: List[str] = []
+    current: List[str] = []
+    current_size = 0
+    fence: Optional[str] = None
+    close_size = measure(_FENCE_CLOSE)
+
+    def flush() -> None:
+        nonlocal current, current_size
+        body = "".join(current)
+        if fence is not None:
+            body = body.rstrip("\n") + _FENCE_CLOSE
+        if body.strip():
+            chunks.append(body)
+        current = [fence + "\n"] if fence is not None else []
+        current_size = measure(current[0]) if current else 0
+
+    for line in text.splitlines(keepends=True):
+        fence_count = line.count(_FENCE)
+        reopen_size = measure(fence + "\n") if fence is not None else measure(_FENCE + "\n")
+        budget = max(limit - reopen_size - close_size, 1)
+        pieces = [line] if measure(line) <= budget else _split_long_line(line, budget, measure)
+        for piece in pieces:
+            size = measure(piece)
+            reserve = close_size if fence is not None or fence_count else 0
+            if current and current_size + size + reserve > limit:
+                flush()
+            current.append(piece)
+            current_size += size
+        if fence_count % 2:
+            if fence is None:
+                stripped = line.strip()
+                fence = stripped if stripped.startswith(_FENCE) and fence_count == 1 else _FENCE
+            else:
+                fence = None
+    flush()
+    return chunks
+
+
+def format_user_reply(ai_text: str) -> List[str]:
+    """Chunks of an AI reply for the user, sent with ParseMode.MARKDOWN"""
+    chunks = split_message(ai_text, TELEGRAM_MESSAGE_LIMIT - utf16_len(USER_REPLY_HEADER))
+    chunks[0] = USER_REPLY_HEADER + chunks[0]
+    return chunks
+
+
+def format_topic_copy(ai_text: str) -> List[str]:
+    """MarkdownV2-escaped chunks of the AI reply copy posted in the user's topic"""
+    overhead = escaped_len("🤖 *AI Response (99/99):*\n---\n\n---")
+    chunks = split_message(ai_text, TELEGRAM_MESSAGE_LIMIT - overhead, measure=escaped_len)
+    total = len(chunks)
+    formatted = []
+    for number, chunk in enumerate(chunks, start=1):
+        part = f" ({number}/{total})" if total > 1 else ""
+        formatted.append(escape_markdown_v2(f"🤖 *AI Response{part}:*\n---\n{chunk}\n---"))
+    return formatted
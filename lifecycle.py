@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from data_management import atomic_write_bytes, serialize_json
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE_PATH = "checkpoint.json"
+CHECKPOINT_INTERVAL_SECONDS = 5
+SHUTDOWN_DRAIN_TIMEOUT_SECONDS = 20
+# Telegram re-delivers unconfirmed updates as soon as polling starts; after this
+# the checkpoint no longer filters anything
+RESUME_WINDOW_SECONDS = 60
+
+_accepting = True
+_final_flush_done = False
+_inflight: Set[asyncio.Task] = set()
+# Each flusher returns (path, serialized bytes) of one piece of state
+_flushers: Dict[str, Callable[[], Tuple[str, bytes]]] = {}
+_dirty: Set[str] = set()
+_checkpoint_task: Optional[asyncio.Task] = None
+_checkpoint_stop: Optional[asyncio.Event] = None
+_flush_lock: Optional[asyncio.Lock] = None
+
+# Per bot: highest update id whose handlers have run, and the one last written to disk
+_last_processed_update_ids: Dict[str, int] = {}
+_checkpointed_update_ids: Dict[str, int] = {}
+# Per bot: updates up to this id were handled before the last restart. Only used
+# for the backlog re-delivered at startup, since Telegram may restart update ids
+# at a random lower value after a week without updates.
+_resume_after_update_ids: Dict[str, int] = {}
+_resume_deadline = 0.0
+
+
+def register_flusher(name: str, snapshot: Callable[[], Tuple[str, bytes]]) -> None:
+    """Register a function that serializes one piece of state for writing to disk.
+
+    Snapshots are taken on the event loop so the state cannot change while it
+    is serialized; the write and fsyncs then run in an executor. Flushers run
+    in registration order, before the update checkpoint is written.
+    """
+    _flushers[name] = snapshot
+
+
+def mark_dirty(name: str) -> None:
+    """Mark state as changed so the next checkpoint writes it"""
+    _dirty.add(name)
+
+
+async def flush_dirty() -> None:
+    """Write all dirty state, then advance the update checkpoint"""
+    global _checkpointed_update_ids, _flush_lock
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    async with _flush_lock:
+        # Every update handled so far is covered by the snapshots taken below.
+        # Updates handled during the writes may dirty state again; they are
+        # left for the next checkpoint.
+        update_ids = dict(_last_processed_update_ids)
+        failed = False
+        for name, snapshot in list(_flushers.items()):
+            if name in _dirty:
+                _dirty.discard(name)
+                try:
+                    path, payload = snapshot()
+                    await loop.run_in_executor(None, atomic_write_bytes, path, payload)
+                except Exception:
+                    logger.exception(f"Failed to flush {name}")
+                    _dirty.add(name)
+                    failed = True
+
+        if failed or update_ids == _checkpointed_update_ids:
+            # Never checkpoint past updates whose state failed to flush
+            return
+        try:
+            payload = serialize_json({"last_update_ids": update_ids})
+            await loop.run_in_executor(None, atomic_write_bytes, CHECKPOINT_FILE_PATH, payload)
+            _checkpointed_update_ids = update_ids
+        except Exception:
+            logger.exception(f"Failed to write checkpoint to {CHECKPOINT_FILE_PATH}")
+
+
+def load_checkpoint(default_bot: str = "default") -> Dict[str, int]:
+    """Load the last processed update id of each bot written before the previous shutdown"""
+    global _resume_after_update_ids, _checkpointed_update_ids, _last_processed_update_ids
+    try:
+        if os.path.exists(CHECKPOINT_FILE_PATH):
+            with open(CHECKPOINT_FILE_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict) and isinstance(data.get("last_update_id"), int):
+                # Checkpoint written by a single-bot version
+                update_ids = {default_bot: data["last_update_id"]}
+            else:
+                update_ids = data.get("last_update_ids") if isinstance(data, dict) else None
+            if isinstance(update_ids, dict) and all(isinstance(v, int) for v in update_ids.values()):
+                _resume_after_update_ids = dict(update_ids)
+                _checkpointed_update_ids = dict(update_ids)
+                _last_processed_update_ids = dict(update_ids)
+                logger.info(f"Resuming after updates {update_ids} from {CHECKPOINT_FILE_PATH}")
+                return update_ids
+            logger.warning(f"Invalid format in {CHECKPOINT_FILE_PATH}. Ignoring checkpoint.")
+    except (OSError, json.JSONDecodeError):
+        logger.exception(f"Failed to load checkpoint from {CHECKPOINT_FILE_PATH}. Ignoring checkpoint.")
+    return {}
+
+
+def start_resume_window(window: float = RESUME_WINDOW_SECONDS) -> None:
+    """Start filtering re-delivered updates; call right before polling starts"""
+    global _resume_deadline
+    _resume_deadline = time.monotonic() + window
+
+
+def is_already_processed(bot: str, update_id: int) -> bool:
+    """True for updates Telegram re-delivers after a restart that were handled before it"""
+    resume_after = _resume_after_update_ids.get(bot)
+    if resume_after is None:
+        return False
+    if update_id > resume_after or time.monotonic() > _resume_deadline:
+        # Past the re-delivered backlog; stop comparing against the old checkpoint
+        del _resume_after_update_ids[bot]
+        return False
+    return True
+
+
+def record_processed(bot: str, update_id: int) -> None:
+    # Updates are handled in order, so the latest one is the resume point, even
+    # when Telegram has restarted ids at a lower value
+    _last_processed_update_ids[bot] = update_id
+
+
+def is_accepting() -> bool:
+    """False once shutdown has started and no new background work should begin"""
+    return _accepting
+
+
+def begin_shutdown() -> None:
+    global _accepting
+    if _accepting:
+        logger.info("Shutdown started; no new background work will be accepted.")
+    _accepting = False
+
+
+def track(coro: Awaitable[Any], name: Optional[str] = None) -> asyncio.Task:
+    """Run a coroutine as a background task that shutdown waits for"""
+    task = asyncio.ensure_future(coro)
+    if name and hasattr(task, "set_name"):
+        task.set_name(name)
+    _inflight.add(task)
+    task.add_done_callback(_inflight.discard)
+    return task
+
+
+async def drain(timeout: float = SHUTDOWN_DRAIN_TIMEOUT_SECONDS) -> None:
+    """Wait for tracked tasks until the deadline, then cancel the rest"""
+    if not _inflight:
+        return
+    logger.info(f"Waiting up to {timeout}s for {len(_inflight)} in-flight task(s).")
+    _, pending = await asyncio.wait(set(_inflight), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning(f"Cancelled {len(pending)} task(s) still running after {timeout}s.")
+        await asyncio.wait(pending)
+
+
+async def _run_checkpoints(interval: float, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            await flush_dirty()
+
+
+def start_checkpoints(interval: float = CHECKPOINT_INTERVAL_SECONDS) -> None:
+    """Flush dirty state periodically so a crash loses at most one interval"""
+    global _checkpoint_task, _checkpoint_stop
+    if _checkpoint_task is None:
+        _checkpoint_stop = asyncio.Event()
+        _checkpoint_task = asyncio.ensure_future(_run_checkpoints(interval, _checkpoint_stop))
+
+
+async def final_flush() -> None:
+    """Stop periodic checkpoints and flush dirty state one last time"""
+    global _checkpoint_task, _final_flush_done
+    if _final_flush_done:
+        return
+    _final_flush_done = True
+    if _checkpoint_task is not None:
+        # Let a running flush finish instead of cancelling it halfway through a write
+        _checkpoint_stop.set()
+        await _checkpoint_task
+        _checkpoint_task = None
+    await flush_dirty()
+    logger.info("Final checkpoint written.")
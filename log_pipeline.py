@@ -0,0 +1,135 @@
+import atexit
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Any, Dict, Optional
+
+# Fraction of updates whose per-message INFO lines are written
+LOG_SAMPLE_RATE = 0.1
+LOG_QUEUE_SIZE = 10000
+
+# Pass as ``extra=SAMPLED`` on INFO lines emitted for every message
+SAMPLED = {"sampled": True}
+
+_CONTEXT_FIELDS = ("correlation_id", "tenant", "user_id", "topic_id")
+
+_log_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+_correlation_counter = itertools.count(1)
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def start_update_context(update_id: Optional[int] = None, **fields: Any) -> str:
+    """Start a fresh log context for an update and return its correlation id"""
+    correlation_id = f"u{update_id}" if update_id is not None else f"c{next(_correlation_counter)}"
+    _log_context.set({"correlation_id": correlation_id, **fields})
+    return correlation_id
+
+
+def bind_log_context(**fields: Any) -> None:
+    """Add fields such as tenant, user_id or topic_id to the current log context"""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the current log context and drops unsampled INFO lines.
+
+    Runs in the thread that logs, so contextvars are still visible. Sampling is
+    decided per correlation id, which keeps all lines of a sampled update together.
+    """
+
+    def __init__(self, sample_rate: float = LOG_SAMPLE_RATE) -> None:
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def _is_sampled(self, correlation_id: Optional[str]) -> bool:
+        if self.sample_rate >= 1:
+            return True
+        if self.sample_rate <= 0:
+            return False
+        if correlation_id is None:
+            return random.random() < self.sample_rate
+        return (hash(correlation_id) % 10000) < self.sample_rate * 10000
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _log_context.get()
+        for field in _CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, context.get(field))
+        if getattr(record, "sampled", False) and record.levelno <= logging.INFO:
+            return self._is_sampled(record.correlation_id)
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves message formatting to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block the event loop on log I/O; drop the record instead
+            pass
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in _CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level: int = logging.INFO, sample_rate: float = LOG_SAMPLE_RATE, json_output: bool = True) -> None:
+    """Route all logging through a queue drained by a background thread"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if json_output:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter(sample_rate))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # httpx logs every getUpdates poll at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the background thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,171 @@
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_INDEX_FILE_PATH = "message_index.sqlite3"
+MESSAGE_INDEX_CACHE_SIZE = 10000
+MESSAGE_INDEX_TTL_SECONDS = 30 * 24 * 60 * 60
+# Number of inserts between two sweeps of expired rows
+MESSAGE_INDEX_PRUNE_INTERVAL = 1000
+
+# (chat_id, message_thread_id or 0, message_id)
+MessageLink = Tuple[int, int, int]
+
+
+class MessageIndex:
+    """Two-way map between relayed messages and the copies the bot sent.
+
+    Each relay is stored as (source chat, source message) -> (target chat,
+    target thread, target message). Lookups in both directions go through an
+    in-memory LRU and fall back to a SQLite table on disk. Rows older than
+    ``ttl`` seconds are treated as missing and removed periodically.
+    """
+
+    def __init__(
+        self,
+        path: str = MESSAGE_INDEX_FILE_PATH,
+        cache_size: int = MESSAGE_INDEX_CACHE_SIZE,
+        ttl: int = MESSAGE_INDEX_TTL_SECONDS,
+    ) -> None:
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = path
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._forward: "OrderedDict[Tuple[int, int], Tuple[MessageLink, int]]" = OrderedDict()
+        self._backward: "OrderedDict[Tuple[int, int], Tuple[Tuple[int, int], int]]" = OrderedDict()
+        self._inserts_since_prune = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS relayed ("
+            " src_chat INTEGER NOT NULL,"
+            " src_msg INTEGER NOT NULL,"
+            " dst_chat INTEGER NOT NULL,"
+            " dst_thread INTEGER NOT NULL,"
+            " dst_msg INTEGER NOT NULL,"
+            " created INTEGER NOT NULL,"
+            " PRIMARY KEY (src_chat, src_msg)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS relayed_dst ON relayed (dst_chat, dst_msg)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS relayed_created ON relayed (created)")
+        self._conn.commit()
+        self.prune()
+
+    def _is_expired(self, created: int) -> bool:
+        return created < time.time() - self.ttl
+
+    def _remember(self, source: Tuple[int, int], target: MessageLink, created: int) -> None:
+        self._forward[source] = (target, created)
+        self._forward.move_to_end(source)
+        target_key = (target[0], target[2])
+        self._backward[target_key] = (source, created)
+        self._backward.move_to_end(target_key)
+        while len(self._forward) > self.cache_size:
+            self._forward.popitem(last=False)
+        while len(self._backward) > self.cache_size:
+            self._backward.popitem(last=False)
+
+    def add(self, src_chat: int, src_msg: int, dst_chat: int, dst_thread: Optional[int], dst_msg: int) -> None:
+        """Record that ``src_msg`` in ``src_chat`` was relayed as ``dst_msg`` in ``dst_chat``."""
+        created = int(time.time())
+        target = (dst_chat, dst_thread or 0, dst_msg)
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO relayed VALUES (?, ?, ?, ?, ?, ?)",
+                (src_chat, src_msg, dst_chat, dst_thread or 0, dst_msg, created),
+            )
+            self._conn.commit()
+        except sqlite3.Error:
+            logger.exception(f"Failed to store message link {src_chat}:{src_msg} -> {dst_chat}:{dst_msg}")
+        self._remember((src_chat, src_msg), target, created)
+
+        self._inserts_since_prune += 1
+        if self._inserts_since_prune >= MESSAGE_INDEX_PRUNE_INTERVAL:
+            self.prune()
+
+    def get_target(self, src_chat: int, src_msg: int) -> Optional[MessageLink]:
+        """Return (chat, thread, message) of the copy of a relayed message, if known."""
+        key = (src_chat, src_msg)
+        cached = self._forward.get(key)
+        if cached is not None:
+            target, created = cached
+            if self._is_expired(created):
+                del self._forward[key]
+                return None
+            self._forward.move_to_end(key)
+            return target
+        row = self._conn.execute(
+            "SELECT dst_chat, dst_thread, dst_msg, created FROM relayed WHERE src_chat = ? AND src_msg = ?",
+            key,
+        ).fetchone()
+        if row is None or self._is_expired(row[3]):
+            return None
+        target = (row[0], row[1], row[2])
+        self._remember(key, target, row[3])
+        return target
+
+    def get_source(self, dst_chat: int, dst_msg: int) -> Optional[Tuple[int, int]]:
+        """Return (chat, message) of the original message behind a relayed copy, if known."""
+        key = (dst_chat, dst_msg)
+        cached = self._backward.get(key)
+        if cached is not None:
+            source, created = cached
+            if self._is_expired(created):
+                del self._backward[key]
+                return None
+            self._backward.move_to_end(key)
+            return source
+        row = self._conn.execute(
+            "SELECT src_chat, src_msg, dst_thread, created FROM relayed WHERE dst_chat = ? AND dst_msg = ?",
+            key,
+        ).fetchone()
+        if row is None or self._is_expired(row[3]):
+            return None
+        source = (row[0], row[1])
+        self._remember(source, (dst_chat, row[2], dst_msg), row[3])
+        return source
+
+    def remove(self, src_chat: int, src_msg: int) -> None:
+        """Forget the link for a relayed message, e.g. after its copy was deleted."""
+        cached = self._forward.pop((src_chat, src_msg), None)
+        if cached is not None:
+            target = cached[0]
+            self._backward.pop((target[0], target[2]), None)
+        try:
+            row = self._conn.execute(
+                "SELECT dst_chat, dst_msg FROM relayed WHERE src_chat = ? AND src_msg = ?",
+                (src_chat, src_msg),
+            ).fetchone()
+            if row is not None:
+                self._backward.pop((row[0], row[1]), None)
+            self._conn.execute("DELETE FROM relayed WHERE src_chat = ? AND src_msg = ?", (src_chat, src_msg))
+            self._conn.commit()
+        except sqlite3.Error:
+            logger.exception(f"Failed to remove message link {src_chat}:{src_msg}")
+
+    def prune(self) -> None:
+        """Delete rows older than the configured TTL."""
+        self._inserts_since_prune = 0
+        cutoff = int(time.time() - self.ttl)
+        try:
+            cursor = self._conn.execute("DELETE FROM relayed WHERE created < ?", (cutoff,))
+            self._conn.commit()
+            if cursor.rowcount:
+                logger.info(f"Pruned {cursor.rowcount} expired message links from {self.path}")
+        except sqlite3.Error:
+            logger.exception(f"Failed to prune expired message links from {self.path}")
+
+    def close(self) -> None:
+        try:
+            self._conn.close()
+        except sqlite3.Error:
+            logger.exception(f"Error closing message index {self.path}")
@@ -0,0 +1,174 @@
+import time
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+# AI replies per minute and burst size
+USER_AI_REPLIES_PER_MINUTE = 6
+USER_AI_BURST = 3
+GLOBAL_AI_REPLIES_PER_MINUTE = 60
+GLOBAL_AI_BURST = 15
+
+# Per-tag overrides of the user quota, e.g. {"vip": (30, 10), "muted": (0, 0)}.
+# When a user has several matching tags the most generous quota wins.
+TAG_QUOTA_OVERRIDES: Dict[str, Tuple[float, int]] = {}
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at ``per_minute / 60`` tokens per second"""
+
+    __slots__ = ("per_minute", "burst", "tokens", "updated")
+
+    def __init__(self, per_minute: float, burst: int) -> None:
+        self.per_minute = per_minute
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(float(self.burst), self.tokens + elapsed * self.per_minute / 60)
+        self.updated = now
+
+    def available(self, now: Optional[float] = None) -> float:
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def give_back(self) -> None:
+        self.tokens = min(float(self.burst), self.tokens + 1)
+
+    def seconds_until_available(self) -> Optional[float]:
+        """Seconds until one token is available, or None if the bucket never refills"""
+        missing = 1 - self.available()
+        if missing <= 0:
+            return 0.0
+        if self.per_minute <= 0:
+            return None
+        return missing * 60 / self.per_minute
+
+    def reset(self) -> None:
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+
+_global_bucket = TokenBucket(GLOBAL_AI_REPLIES_PER_MINUTE, GLOBAL_AI_BURST)
+# Keyed by (tenant name, user id) so bots sharing the process do not share user quotas
+_user_buckets: Dict[Hashable, TokenBucket] = {}
+# With several tenants each gets an equal share of the global quota, so one
+# busy tenant cannot use it all
+_tenant_buckets: Dict[Hashable, TokenBucket] = {}
+
+
+def configure_tenants(names: Iterable[str]) -> None:
+    """Split the global AI reply quota evenly between the given tenants"""
+    names = list(names)
+    _tenant_buckets.clear()
+    if len(names) < 2:
+        return
+    per_minute = GLOBAL_AI_REPLIES_PER_MINUTE / len(names)
+    burst = max(1, GLOBAL_AI_BURST // len(names))
+    for name in names:
+        _tenant_buckets[name] = TokenBucket(per_minute, burst)
+
+
+def _tenant_bucket(user_key: Hashable) -> Optional[TokenBucket]:
+    if isinstance(user_key, tuple):
+        return _tenant_buckets.get(user_key[0])
+    return None
+
+
+def quota_for_tags(tags: Iterable[str]) -> Tuple[float, int]:
+    """Return (replies per minute, burst) for a user with the given tags"""
+    matches = [TAG_QUOTA_OVERRIDES[tag] for tag in tags if tag in TAG_QUOTA_OVERRIDES]
+    if not matches:
+        return USER_AI_REPLIES_PER_MINUTE, USER_AI_BURST
+    return max(matches)
+
+
+def _user_bucket(user_key: Hashable, tags: Iterable[str]) -> TokenBucket:
+    per_minute, burst = quota_for_tags(tags)
+    bucket = _user_buckets.get(user_key)
+    if bucket is None or bucket.per_minute != per_minute or bucket.burst != burst:
+        bucket = TokenBucket(per_minute, burst)
+        _user_buckets[user_key] = bucket
+    return bucket
+
+
+def try_consume(user_key: Hashable, tags: Iterable[str]) -> Optional[str]:
+    """Take one AI reply from the user and global quotas.
+
+    Returns None when allowed, otherwise "user", "tenant" or "global" naming
+    the exhausted quota. Nothing is taken from any bucket when refused.
+    """
+    now = time.monotonic()
+    bucket = _user_bucket(user_key, tags)
+    tenant_bucket = _tenant_bucket(user_key)
+    if bucket.available(now) < 1:
+        return "user"
+    if tenant_bucket is not None and tenant_bucket.available(now) < 1:
+        return "tenant"
+    if _global_bucket.available(now) < 1:
+        return "global"
+    bucket.take()
+    if tenant_bucket is not None:
+        tenant_bucket.take()
+    _global_bucket.take()
+    return None
+
+
+def refund(user_key: Hashable) -> None:
+    """Return the reply taken by try_consume when it could not be used"""
+    bucket = _user_buckets.get(user_key)
+    if bucket is not None:
+        bucket.give_back()
+    tenant_bucket = _tenant_bucket(user_key)
+    if tenant_bucket is not None:
+        tenant_bucket.give_back()
+    _global_bucket.give_back()
+
+
+def _format_bucket(bucket: TokenBucket) -> str:
+    wait = bucket.seconds_until_available()
+    if wait is None:
+        status = "blocked"
+    elif wait == 0:
+        status = "available"
+    else:
+        status = f"next in {wait:.0f}s"
+    return f"{bucket.available():.1f}/{bucket.burst} left, {bucket.per_minute:g}/min ({status})"
+
+
+def describe_quota(user_key: Hashable, tags: Iterable[str]) -> str:
+    lines = [f"User: {_format_bucket(_user_bucket(user_key, tags))}"]
+    tenant_bucket = _tenant_bucket(user_key)
+    if tenant_bucket is not None:
+        lines.append(f"Bot: {_format_bucket(tenant_bucket)}")
+    lines.append(f"Global: {_format_bucket(_global_bucket)}")
+    return "\n".join(lines)
+
+
+def reset_quota(user_key: Hashable) -> None:
+    """Refill one user's bucket"""
+    if user_key in _user_buckets:
+        _user_buckets[user_key].reset()
+
+
+def reset_all_quotas(tenant: Optional[str] = None) -> None:
+    """Refill every user bucket and the share of one tenant, or all buckets including the global one"""
+    if tenant is None:
+        _user_buckets.clear()
+        for bucket in _tenant_buckets.values():
+            bucket.reset()
+        _global_bucket.reset()
+        return
+    for user_key in [key for key in _user_buckets if isinstance(key, tuple) and key[0] == tenant]:
+        del _user_buckets[user_key]
+    if tenant in _tenant_buckets:
+        _tenant_buckets[tenant].reset()
+
+
+def reset_global_quota() -> None:
+    """Refill the quota shared by all tenants"""
+    _global_bucket.reset()
@@ -0,0 +1,317 @@
+"""Replay stored conversations through the bot's prompt and storage code.
+
+Reads a conversation_history.json and user_topic_map.json, replays every
+stored message through get_conversation_history, add_to_conversation_history,
+the prompt assembly in generate_ai_reply and the persistence functions, with
+a stubbed Gemini model, and reports per-stage CPU time and allocations,
+prompt sizes and bytes written per message. The input files are copied to a
+temporary directory and never modified.
+
+Usage:
+    python replay_profile.py [--history conversation_history.json] [--map user_topic_map.json]
+                             [--flush-every 1] [--cprofile replay.prof] [--json report.json]
+
+The --cprofile output can be browsed with snakeviz or turned into a
+flamegraph with flameprof. Requires Python 3.9+ for tracemalloc.reset_peak.
+"""
+import argparse
+import asyncio
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import data_management
+import Infinity
+from tenants import DEFAULT_TENANT_NAME, Tenant, set_current_tenant
+
+STUB_REPLY = "Stub reply."
+
+
+class StageStats:
+    """Accumulated CPU time and allocations for one replayed function"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.cpu_seconds = 0.0
+        self.allocated_bytes = 0
+        self.peak_bytes = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "cpu_ms_total": round(self.cpu_seconds * 1000, 3),
+            "cpu_us_per_call": round(self.cpu_seconds * 1e6 / self.calls, 2) if self.calls else 0,
+            "net_alloc_bytes": self.allocated_bytes,
+            "peak_alloc_bytes": self.peak_bytes,
+        }
+
+
+class Profiler:
+    """Wraps module functions to time them and measure their allocations.
+
+    The tracemalloc peak is reset when a stage starts, so each stage reports
+    its own peak. Stages may nest (generate_ai_reply calls build_ai_prompt);
+    the peak reached so far by each enclosing stage is kept before the reset.
+    The replay runs one stage at a time, so the active stages form a stack.
+    """
+
+    def __init__(self) -> None:
+        self.stages: Dict[str, StageStats] = {}
+        # Peak traced memory reached so far by each active stage, outermost first
+        self._peaks: List[int] = []
+
+    def _enter(self) -> int:
+        current, peak = tracemalloc.get_traced_memory()
+        self._peaks = [max(stage_peak, peak) for stage_peak in self._peaks]
+        self._peaks.append(current)
+        tracemalloc.reset_peak()
+        return current
+
+    def _record(self, name: str, cpu_start: float, mem_start: int) -> None:
+        stats = self.stages.setdefault(name, StageStats())
+        current, peak = tracemalloc.get_traced_memory()
+        stage_peak = max(self._peaks.pop(), peak)
+        stats.calls += 1
+        stats.cpu_seconds += time.process_time() - cpu_start
+        stats.allocated_bytes += current - mem_start
+        stats.peak_bytes = max(stats.peak_bytes, stage_peak - mem_start)
+
+    def wrap(self, module: Any, name: str) -> None:
+        func = getattr(module, name)
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_async(*args: Any, **kwargs: Any) -> Any:
+                mem_start = self._enter()
+                cpu_start = time.process_time()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._record(name, cpu_start, mem_start)
+            setattr(module, name, timed_async)
+        else:
+            @functools.wraps(func)
+            def timed(*args: Any, **kwargs: Any) -> Any:
+                mem_start = self._enter()
+                cpu_start = time.process_time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._record(name, cpu_start, mem_start)
+            setattr(module, name, timed)
+
+
+class StubModel:
+    """Stands in for genai.Client; returns the recorded reply and keeps prompt sizes"""
+
+    def __init__(self) -> None:
+        self.prompt_sizes: List[int] = []
+        self.next_reply = STUB_REPLY
+        self.models = self
+
+    def __call__(self, api_key: Optional[str] = None) -> "StubModel":
+        return self
+
+    def generate_content(self, model: str, contents: str) -> SimpleNamespace:
+        self.prompt_sizes.append(len(contents.encode("utf-8")))
+        return SimpleNamespace(text=self.next_reply)
+
+
+def _percentile(values: List[int], fraction: float) -> int:
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _build_replay(history: Dict[str, List[Dict[str, str]]]) -> List[Tuple[int, str, str, Optional[str]]]:
+    """Interleave users round-robin into (user_id, role, message, recorded reply) steps"""
+    per_user = []
+    for user_id_str, entries in history.items():
+        try:
+            user_id = int(user_id_str)
+        except ValueError:
+            continue
+        steps = []
+        i = 0
+        while i < len(entries):
+            entry = entries[i]
+            reply = None
+            if entry.get("role") == "user" and i + 1 < len(entries) and entries[i + 1].get("role") != "user":
+                reply = entries[i + 1].get("message")
+                i += 1
+            steps.append((user_id, entry.get("role", "user"), entry.get("message", ""), reply))
+            i += 1
+        per_user.append(steps)
+
+    replay = []
+    for position in range(max((len(steps) for steps in per_user), default=0)):
+        for steps in per_user:
+            if position < len(steps):
+                replay.append(steps[position])
+    return replay
+
+
+def replay(history_path: str, map_path: str, flush_every: int, work_dir: str) -> Dict[str, Any]:
+    with open(history_path, "r", encoding="utf-8") as f:
+        source_history = json.load(f)
+
+    tenant = Tenant(
+        name=DEFAULT_TENANT_NAME,
+        bot_token="",
+        support_group_id=Infinity.SUPPORT_GROUP_ID,
+        your_name=Infinity.YOUR_NAME,
+        base_prompt=Infinity.GEMINI_BASE_PROMPT,
+        gemini_api_key=Infinity.GEMINI_API_KEY,
+        data_dir=work_dir,
+    )
+    if os.path.exists(map_path):
+        shutil.copyfile(map_path, tenant.data_file_path)
+    set_current_tenant(tenant)
+    Infinity.load_data()
+    tenant.conversation_history = {}
+    tenant.search_index.rebuild(tenant.conversation_history)
+
+    stub = StubModel()
+    Infinity.genai = SimpleNamespace(Client=stub)
+    # Replay every stored user, including those with AI mode turned off
+    Infinity.is_ai_mode_enabled = lambda user_id: True
+
+    profiler = Profiler()
+    for name in ("get_conversation_history", "add_to_conversation_history", "format_conversation_history",
+                 "build_ai_prompt", "generate_ai_reply", "snapshot_conversation_history", "snapshot_data"):
+        profiler.wrap(Infinity, name)
+    profiler.wrap(data_management, "atomic_write_bytes")
+
+    steps = _build_replay(source_history)
+    bytes_written = 0
+    saves = 0
+    messages = 0
+    unsaved = 0
+
+    def flush() -> None:
+        nonlocal bytes_written, saves, unsaved
+        data_management.atomic_write_bytes(*Infinity.snapshot_conversation_history())
+        bytes_written += os.path.getsize(tenant.conversation_history_file_path)
+        saves += 1
+        unsaved = 0
+
+    async def run() -> None:
+        nonlocal messages, unsaved
+        for user_id, role, message, reply in steps:
+            if role == "user":
+                stub.next_reply = reply or STUB_REPLY
+                history = Infinity.get_conversation_history(user_id)
+                Infinity.add_to_conversation_history(user_id, "user", message)
+                await Infinity.generate_ai_reply(message, user_id, history)
+                added = 2
+            else:
+                Infinity.add_to_conversation_history(user_id, role, message)
+                added = 1
+            messages += added
+            unsaved += added
+            if unsaved >= flush_every:
+                flush()
+        if unsaved or not saves:
+            flush()
+        data_management.atomic_write_bytes(*Infinity.snapshot_data())
+
+    wall_start = time.perf_counter()
+    asyncio.run(run())
+    wall_seconds = time.perf_counter() - wall_start
+
+    sizes = stub.prompt_sizes
+    return {
+        "users": len(source_history),
+        "replayed_messages": messages,
+        "wall_seconds": round(wall_seconds, 3),
+        "stages": {name: stats.as_dict() for name, stats in profiler.stages.items()},
+        "prompt_bytes": {
+            "count": len(sizes),
+            "min": min(sizes, default=0),
+            "p50": _percentile(sizes, 0.5),
+            "p90": _percentile(sizes, 0.9),
+            "p99": _percentile(sizes, 0.99),
+            "max": max(sizes, default=0),
+            "mean": round(sum(sizes) / len(sizes), 1) if sizes else 0,
+        },
+        "persistence": {
+            "history_saves": saves,
+            "bytes_written": bytes_written,
+            "bytes_per_message": round(bytes_written / messages, 1) if messages else 0,
+            "final_history_bytes": os.path.getsize(tenant.conversation_history_file_path),
+        },
+    }
+
+
+def _top_allocations(snapshot: tracemalloc.Snapshot, limit: int = 10) -> List[Dict[str, Any]]:
+    stats = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")
+    return [
+        {"location": str(stat.traceback), "count": stat.count, "bytes": stat.size}
+        for stat in stats[:limit]
+    ]
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"Replayed {report['replayed_messages']} messages from {report['users']} users in {report['wall_seconds']}s\n")
+    print(f"{'stage':32} {'calls':>8} {'cpu ms':>10} {'us/call':>10} {'net alloc':>12} {'peak alloc':>12}")
+    for name, stats in report["stages"].items():
+        print(f"{name:32} {stats['calls']:>8} {stats['cpu_ms_total']:>10} {stats['cpu_us_per_call']:>10} "
+              f"{stats['net_alloc_bytes']:>12} {stats['peak_alloc_bytes']:>12}")
+    prompt = report["prompt_bytes"]
+    print(f"\nPrompt size (bytes): n={prompt['count']} min={prompt['min']} p50={prompt['p50']} "
+          f"p90={prompt['p90']} p99={prompt['p99']} max={prompt['max']} mean={prompt['mean']}")
+    persistence = report["persistence"]
+    print(f"History saves: {persistence['history_saves']}, bytes written: {persistence['bytes_written']} "
+          f"({persistence['bytes_per_message']} per message), final file: {persistence['final_history_bytes']} bytes")
+    print("\nTop allocation sites:")
+    for site in report["top_allocations"]:
+        print(f"  {site['location']}: {site['count']} blocks, {site['bytes']} bytes")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay stored conversations and profile prompt and storage stages.")
+    parser.add_argument("--history", default=Infinity.CONVERSATION_HISTORY_FILE_PATH, help="conversation history JSON to replay")
+    parser.add_argument("--map", default=Infinity.DATA_FILE_PATH, help="user topic map JSON for user info and tags")
+    parser.add_argument("--flush-every", type=int, default=1, help="save history after this many replayed messages")
+    parser.add_argument("--cprofile", metavar="FILE", help="write cProfile stats to FILE")
+    parser.add_argument("--json", metavar="FILE", help="write the report as JSON to FILE")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.history):
+        parser.error(f"{args.history} not found")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    profile = cProfile.Profile() if args.cprofile else None
+    with tempfile.TemporaryDirectory() as work_dir:
+        tracemalloc.start()
+        if profile:
+            profile.enable()
+        report = replay(args.history, args.map, max(args.flush_every, 1), work_dir)
+        if profile:
+            profile.disable()
+        report["top_allocations"] = _top_allocations(tracemalloc.take_snapshot())
+        tracemalloc.stop()
+
+    print_report(report)
+    if profile:
+        profile.dump_stats(args.cprofile)
+        print(f"\ncProfile stats written to {args.cprofile}; top functions by cumulative time:")
+        pstats.Stats(profile, stream=sys.stdout).sort_stats("cumulative").print_stats(15)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+AI_WORKER_COUNT = 4
+MAX_PENDING_PER_USER = 5
+
+Job = Callable[[], Awaitable[Any]]
+DropCallback = Optional[Callable[[], Any]]
+
+
+class FairScheduler:
+    """Runs queued jobs on a fixed pool of workers, round-robin across groups, then keys.
+
+    Jobs sharing a key (a user) run one at a time and in submission order.
+    Keys belong to groups (tenants) given by ``group_of``. A free worker
+    takes the next group in turn and runs one job of that group's next ready
+    key; both then go to the back of their queues. So a tenant with many
+    busy users gets no more turns than a tenant with one, and one busy user
+    cannot starve the others. Each job runs with the context variables that
+    were set when it was submitted, which keeps log context intact.
+    """
+
+    def __init__(
+        self,
+        workers: int = AI_WORKER_COUNT,
+        max_pending_per_key: int = MAX_PENDING_PER_USER,
+        group_of: Optional[Callable[[Hashable], Hashable]] = None,
+    ) -> None:
+        self.worker_count = workers
+        self.max_pending_per_key = max_pending_per_key
+        self._group_of = group_of or (lambda key: None)
+        self._jobs: Dict[Hashable, Deque[Tuple[Job, contextvars.Context, DropCallback]]] = {}
+        # Ready keys of each group, and the groups that have ready keys, in turn order
+        self._ready_keys: Dict[Hashable, Deque[Hashable]] = {}
+        self._ready: "asyncio.Queue[Hashable]" = asyncio.Queue()
+        self._scheduled_groups: Set[Hashable] = set()
+        self._scheduled: Set[Hashable] = set()
+        self._active: Set[Hashable] = set()
+        self._workers: List[asyncio.Task] = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closed = False
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.worker_count)]
+
+    def pending(self, key: Hashable) -> int:
+        return len(self._jobs.get(key, ()))
+
+    def submit(self, key: Hashable, job: Job, on_drop: DropCallback = None) -> bool:
+        """Queue a job; returns False when closed or the key already has too many pending jobs.
+
+        ``on_drop`` is called if the job is discarded by stop() before it starts.
+        """
+        if self._closed or self.pending(key) >= self.max_pending_per_key:
+            return False
+        self._jobs.setdefault(key, deque()).append((job, contextvars.copy_context(), on_drop))
+        self._idle.clear()
+        if key not in self._scheduled and key not in self._active:
+            self._schedule(key)
+        return True
+
+    def _schedule(self, key: Hashable) -> None:
+        self._scheduled.add(key)
+        group = self._group_of(key)
+        self._ready_keys.setdefault(group, deque()).append(key)
+        self._schedule_group(group)
+
+    def _schedule_group(self, group: Hashable) -> None:
+        if group not in self._scheduled_groups:
+            self._scheduled_groups.add(group)
+            self._ready.put_nowait(group)
+
+    async def _work(self) -> None:
+        while True:
+            group = await self._ready.get()
+            self._scheduled_groups.discard(group)
+            keys = self._ready_keys.get(group)
+            if not keys:
+                continue
+            key = keys.popleft()
+            if keys:
+                # Other users of this group can be served by the next free worker, after other groups
+                self._schedule_group(group)
+            else:
+                del self._ready_keys[group]
+            self._scheduled.discard(key)
+            jobs = self._jobs.get(key)
+            if not jobs:
+                continue
+            job, context, _ = jobs.popleft()
+            self._active.add(key)
+            for var, value in context.items():
+                var.set(value)
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Scheduled job for {key} failed")
+            finally:
+                self._active.discard(key)
+                if jobs:
+                    self._schedule(key)
+                else:
+                    self._jobs.pop(key, None)
+                    if not self._jobs and not self._active:
+                        self._idle.set()
+
+    def close(self) -> None:
+        """Refuse new jobs; queued ones still run"""
+        self._closed = True
+
+    async def join(self) -> None:
+        """Wait until every queued job has finished"""
+        await self._idle.wait()
+
+    async def stop(self) -> None:
+        """Cancel the workers, dropping any jobs that have not finished"""
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.wait(self._workers)
+        self._workers = []
+        dropped = 0
+        for jobs in self._jobs.values():
+            for _, _, on_drop in jobs:
+                dropped += 1
+                if on_drop is not None:
+                    try:
+                        on_drop()
+                    except Exception:
+                        logger.exception("Drop callback of a queued job failed")
+        if dropped:
+            logger.warning(f"Dropped {dropped} queued job(s) on shutdown")
+        self._jobs.clear()
@@ -0,0 +1,99 @@
+import heapq
+import re
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+SEARCH_RESULT_LIMIT = 10
+SEARCH_MIN_TERM_LENGTH = 2
+
+_WORD_RE = re.compile(r"\w+")
+# Scripts written without spaces; runs of these are indexed as overlapping character pairs
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+
+
+def tokenize(text: str) -> Set[str]:
+    """Split text into the lowercase terms used by the index and by queries"""
+    text = text.lower()
+    terms = {word for word in _WORD_RE.findall(_CJK_RE.sub(" ", text)) if len(word) >= SEARCH_MIN_TERM_LENGTH}
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            terms.add(run)
+        else:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+class SearchIndex:
+    """In-memory inverted index over the stored conversation history.
+
+    Each term maps to the users whose history contains it, with the number of
+    stored messages containing the term and when it was last said. The index
+    is kept in step with the history: messages are added as they are stored
+    and removed when the history evicts them. Since history evicts oldest
+    first, the last-said time of a term stays correct while any message with
+    it remains.
+    """
+
+    def __init__(self) -> None:
+        # term -> user id -> [number of stored messages with the term, last time it was said]
+        self._postings: Dict[str, Dict[int, List[float]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._postings)
+
+    def add(self, user_id: int, message: str, timestamp: float) -> None:
+        for term in tokenize(message):
+            posting = self._postings.setdefault(term, {}).get(user_id)
+            if posting is None:
+                self._postings[term][user_id] = [1, timestamp]
+            else:
+                posting[0] += 1
+                posting[1] = max(posting[1], timestamp)
+
+    def remove(self, user_id: int, message: str) -> None:
+        """Forget one stored message, e.g. when it is evicted from the history"""
+        for term in tokenize(message):
+            users = self._postings.get(term)
+            if not users or user_id not in users:
+                continue
+            users[user_id][0] -= 1
+            if users[user_id][0] <= 0:
+                del users[user_id]
+                if not users:
+                    del self._postings[term]
+
+    def rebuild(self, history: Dict[str, List[Dict[str, Any]]]) -> None:
+        """Index a whole conversation history, e.g. after loading it from disk"""
+        self._postings = {}
+        for user_id_str, entries in history.items():
+            try:
+                user_id = int(user_id_str)
+            except ValueError:
+                continue
+            for entry in entries:
+                self.add(user_id, entry.get("message", ""), entry.get("time", 0))
+
+    def search(self, query: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Tuple[int, float]]:
+        """Return (user id, last time all terms were said) for users matching every term, newest first"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        postings = []
+        for term in terms:
+            users = self._postings.get(term)
+            if not users:
+                return []
+            postings.append(users)
+        # Walk the rarest term's users and probe the others
+        postings.sort(key=len)
+        matches = (
+            (user_id, min(users[user_id][1] for users in postings))
+            for user_id in postings[0]
+            if all(user_id in users for users in postings[1:])
+        )
+        return heapq.nlargest(limit, matches, key=lambda match: match[1])
+
+
+def matches_all(message: str, terms: Iterable[str]) -> bool:
+    """True if every term occurs in the message"""
+    message_terms = tokenize(message)
+    return all(term in message_terms for term in terms)
@@ -1,5 +1,6 @@
 import logging
 import json
+import os
 from typing import List, Optional, Tuple, Dict, Any
 from data_management import load_data, save_data
 
@@ -8,17 +9,46 @@ logger = logging.getLogger(__name__)
 # Constants
 DATA_FILE_PATH = "user_topic_map.json"
 
+# Per data file, incremented on every save so cached tags can tell when they are stale
+_tags_generations: Dict[str, int] = {}
+
+def _generation_key(path: Optional[str]) -> str:
+    import data_management
+    return os.path.abspath(path or data_management.DATA_FILE_PATH)
+
+def tags_generation(path: Optional[str] = None) -> int:
+    return _tags_generations.get(_generation_key(path), 0)
+
 # Load data from file
-def load_data() -> Dict[str, Any]:
+def load_data(path: Optional[str] = None) -> Dict[str, Any]:
     # Use the imported load_data function from data_management module
     from data_management import load_data as dm_load_data
-    return dm_load_data()
+    return dm_load_data(path)
 
 # Save data to file
-def save_data(data: Dict[str, Any]) -> bool:
+def save_data(data: Dict[str, Any], path: Optional[str] = None) -> bool:
     # Use the imported save_data function from data_management module
     from data_management import save_data as dm_save_data
-    return dm_save_data(data)
+    saved = dm_save_data(data, path)
+    if saved:
+        key = _generation_key(path)
+        _tags_generations[key] = _tags_generations.get(key, 0) + 1
+    return saved
+
+# Tag functions work on the bot's in-memory map when one is passed as data.
+# The caller then persists it; only the tags generation is advanced here.
+def _load(data: Optional[Dict[str, Any]], path: Optional[str]) -> Dict[str, Any]:
+    if data is None:
+        return load_data(path)
+    data.setdefault("username_tags", {})
+    return data
+
+def _save(data: Dict[str, Any], path: Optional[str], in_memory: bool) -> bool:
+    if not in_memory:
+        return save_data(data, path)
+    key = _generation_key(path)
+    _tags_generations[key] = _tags_generations.get(key, 0) + 1
+    return True
 
 # Get user ID from username
 def get_user_id_from_username(data: Dict[str, Any], username: str) -> Optional[str]:
@@ -34,7 +64,7 @@ def get_user_id_from_username(data: Dict[str, Any], username: str) -> Optional[s
     return None
 
 # Add tag to user by username
-def add_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
+def add_tag_by_username(username: str, tag: str, path: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
     if not username or not tag:
         return False, "Username and tag cannot be empty"
     
@@ -42,7 +72,8 @@ def add_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
     if username.startswith("@"):
         username = username[1:]
     
-    data = load_data()
+    in_memory = data is not None
+    data = _load(data, path)
     
     # Check if user exists in user_mappings
     user_id = get_user_id_from_username(data, username)
@@ -58,7 +89,7 @@ def add_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
         
         # Add tag
         data["user_mappings"][user_id]["tags"].append(tag)
-        if save_data(data):
+        if _save(data, path, in_memory):
             return True, f"Added tag '{tag}' to user @{username}"
         else:
             return False, "Failed to save data"
@@ -73,13 +104,13 @@ def add_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
         
         # Add tag
         data["username_tags"][username].append(tag)
-        if save_data(data):
+        if _save(data, path, in_memory):
             return True, f"Added tag '{tag}' to username @{username} (user not yet in system)"
         else:
             return False, "Failed to save data"
 
 # Remove tag from user by username
-def remove_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
+def remove_tag_by_username(username: str, tag: str, path: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
     if not username or not tag:
         return False, "Username and tag cannot be empty"
     
@@ -87,7 +118,8 @@ def remove_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
     if username.startswith("@"):
         username = username[1:]
     
-    data = load_data()
+    in_memory = data is not None
+    data = _load(data, path)
     
     # Check if user exists in user_mappings
     user_id = get_user_id_from_username(data, username)
@@ -97,7 +129,7 @@ def remove_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
         if tag in data["user_mappings"][user_id]["tags"]:
             # Remove tag
             data["user_mappings"][user_id]["tags"].remove(tag)
-            if save_data(data):
+            if _save(data, path, in_memory):
                 return True, f"Removed tag '{tag}' from user @{username}"
             else:
                 return False, "Failed to save data"
@@ -111,7 +143,7 @@ def remove_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
             # If no tags left, remove username entry
             if not data["username_tags"][username]:
                 del data["username_tags"][username]
-            if save_data(data):
+            if _save(data, path, in_memory):
                 return True, f"Removed tag '{tag}' from username @{username}"
             else:
                 return False, "Failed to save data"
@@ -121,7 +153,7 @@ def remove_tag_by_username(username: str, tag: str) -> Tuple[bool, str]:
         return False, f"No tags found for username @{username}"
 
 # List tags for a user by username
-def list_tags_by_username(username: str) -> Tuple[bool, str, List[str]]:
+def list_tags_by_username(username: str, path: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> Tuple[bool, str, List[str]]:
     if not username:
         return False, "Username cannot be empty", []
     
@@ -129,7 +161,7 @@ def list_tags_by_username(username: str) -> Tuple[bool, str, List[str]]:
     if username.startswith("@"):
         username = username[1:]
     
-    data = load_data()
+    data = _load(data, path)
     
     # Check if user exists in user_mappings
     user_id = get_user_id_from_username(data, username)
@@ -152,8 +184,9 @@ def list_tags_by_username(username: str) -> Tuple[bool, str, List[str]]:
         return False, f"No tags found for username @{username}", []
 
 # Get tags for a user by user_id
-def get_tags_by_user_id(user_id: int) -> List[str]:
-    data = load_data()
+def get_tags_by_user_id(user_id: int, path: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> List[str]:
+    in_memory = data is not None
+    data = _load(data, path)
     user_id_str = str(user_id)
     
     # Check if user exists in user_mappings
@@ -175,7 +208,7 @@ def get_tags_by_user_id(user_id: int) -> List[str]:
             
             # Remove from username_tags
             del data["username_tags"][username]
-            save_data(data)
+            _save(data, path, in_memory)
             
             return data["user_mappings"][user_id_str]["tags"]
     
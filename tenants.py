@@ -0,0 +1,147 @@
+import contextvars
+import json
+import logging
+import os
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+from telegram.request import HTTPXRequest
+
+from search_index import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+TENANTS_CONFIG_PATH = "tenants.json"
+DEFAULT_TENANT_NAME = "default"
+TELEGRAM_CONNECTION_POOL_SIZE = 256
+
+_current_tenant: contextvars.ContextVar = contextvars.ContextVar("current_tenant")
+
+
+class Tenant:
+    """Configuration, storage namespace and metrics of one bot and its support group.
+
+    Each tenant keeps its own user map, conversation history and message index
+    under ``data_dir``. An empty ``data_dir`` keeps the original single-bot file
+    names in the working directory.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        bot_token: str,
+        support_group_id: int,
+        your_name: str,
+        base_prompt: str,
+        gemini_api_key: str,
+        data_dir: str = "",
+    ) -> None:
+        self.name = name
+        self.bot_token = bot_token
+        self.support_group_id = support_group_id
+        self.your_name = your_name
+        self.base_prompt = base_prompt
+        self.gemini_api_key = gemini_api_key
+        self.data_dir = data_dir
+        self.data_file_path = os.path.join(data_dir, "user_topic_map.json")
+        self.conversation_history_file_path = os.path.join(data_dir, "conversation_history.json")
+        self.message_index_file_path = os.path.join(data_dir, "message_index.sqlite3")
+
+        self.user_topic_map: Dict[str, Any] = {"support_group_id": support_group_id, "user_mappings": {}}
+        self.conversation_history: Dict[str, List[Dict[str, str]]] = {}
+        self.message_index = None
+        self.search_index = SearchIndex()
+        # user id -> (tags generation, tags, user-info block of the AI prompt)
+        self.user_contexts: Dict[int, Tuple[int, List[str], str]] = {}
+        self.metrics: Counter = Counter()
+
+    def state_key(self, name: str) -> str:
+        """Name of a piece of this tenant's state for lifecycle flushers"""
+        return f"{self.name}:{name}"
+
+    def __repr__(self) -> str:
+        return f"Tenant({self.name!r}, support_group_id={self.support_group_id})"
+
+
+def current_tenant() -> Tenant:
+    """The tenant whose update or job is being handled"""
+    return _current_tenant.get()
+
+
+def set_current_tenant(tenant: Tenant) -> None:
+    _current_tenant.set(tenant)
+
+
+@contextmanager
+def tenant_scope(tenant: Tenant) -> Iterator[Tenant]:
+    """Make ``tenant`` current for the duration of a block"""
+    token = _current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current_tenant.reset(token)
+
+
+def load_tenants(default: Tenant, base_prompt_template: str, config_path: str = TENANTS_CONFIG_PATH) -> List[Tenant]:
+    """Load tenants from ``config_path``, or run ``default`` alone when there is no config file.
+
+    The config holds a top-level ``gemini_api_key`` and a ``tenants`` list with
+    ``name``, ``bot_token``, ``support_group_id``, ``your_name`` and optional
+    ``base_prompt``, ``gemini_api_key`` and ``data_dir`` (default ``data/<name>``).
+    """
+    if not os.path.exists(config_path):
+        return [default]
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    tenants = []
+    seen = set()
+    for entry in config.get("tenants", []):
+        name = entry["name"]
+        if name in seen:
+            raise ValueError(f"Duplicate tenant name '{name}' in {config_path}")
+        seen.add(name)
+        your_name = entry.get("your_name", default.your_name)
+        tenants.append(Tenant(
+            name=name,
+            bot_token=entry["bot_token"],
+            support_group_id=int(entry["support_group_id"]),
+            your_name=your_name,
+            base_prompt=entry.get("base_prompt") or base_prompt_template.format(name=your_name),
+            gemini_api_key=entry.get("gemini_api_key") or config.get("gemini_api_key") or default.gemini_api_key,
+            data_dir=entry.get("data_dir", os.path.join("data", name)),
+        ))
+    if not tenants:
+        raise ValueError(f"No tenants configured in {config_path}")
+    logger.info(f"Loaded {len(tenants)} tenant(s) from {config_path}: {', '.join(t.name for t in tenants)}")
+    return tenants
+
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest whose connection pool is shared by several bots.
+
+    Bots initialize and shut down their request objects themselves, but a bot
+    whose initialization fails halfway never shuts them down. So the pool is
+    opened by the first bot, bot shutdowns leave it open, and the owner closes
+    it with close() once every bot has stopped.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._open = False
+
+    async def initialize(self) -> None:
+        if not self._open:
+            self._open = True
+            await super().initialize()
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        if self._open:
+            self._open = False
+            await super().shutdown()
+